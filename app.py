@@ -7,6 +7,20 @@ import threading
 import time
 import uuid
 import json
+import re
+import shutil
+import socket
+import sqlite3
+import hashlib
+import atexit
+import contextlib
+import zipfile
+import heapq
+import itertools
+import subprocess
+import gc
+from collections import OrderedDict, deque
+from werkzeug.middleware.proxy_fix import ProxyFix
 from werkzeug.utils import secure_filename
 
 app = Flask(__name__)
@@ -18,198 +32,2448 @@ DOWNLOAD_DIR = tempfile.gettempdir()
 # Optional: Path to cookies file (set via environment variable or upload)
 COOKIES_FILE = os.environ.get('COOKIES_FILE', None)
 
-# Store download progress (in production, use Redis or database)
-download_progress = {}
-download_files = {}  # Store filepath with download_id
+# Optional: directory of cookies.txt files, one per account. Jobs are spread
+# over these sessions and COOKIES_FILE; a session that hits a 429, a bot check
+# or a sign-in wall rests for a cooldown that doubles on each further failure
+COOKIES_DIR = os.environ.get('COOKIES_DIR', None)
+COOKIE_COOLDOWN = int(os.environ.get('COOKIE_COOLDOWN', 300))
+COOKIE_MAX_COOLDOWN = int(os.environ.get('COOKIE_MAX_COOLDOWN', 3600))
+
+# Where job state lives: 'memory' is process-local, 'sqlite' is shared by every
+# gunicorn worker on the host (needed with --workers > 1)
+PROGRESS_STORE = os.environ.get('PROGRESS_STORE', 'memory')
+PROGRESS_DB = os.environ.get('PROGRESS_DB', os.path.join(DOWNLOAD_DIR, 'youtube-downloader-progress.db'))
 progress_lock = threading.Lock()
 
+# Durable journal of submitted jobs; unfinished ones are resumed after a restart
+JOURNAL_DB = os.environ.get('JOURNAL_DB', os.path.join(DOWNLOAD_DIR, 'youtube-downloader-journal.db'))
+
+# yt-dlp calls the progress hook for every chunk; publish at most one update per
+# interval unless progress has moved by at least the delta (percent)
+PROGRESS_UPDATE_INTERVAL = float(os.environ.get('PROGRESS_UPDATE_INTERVAL', 0.5))
+PROGRESS_UPDATE_DELTA = float(os.environ.get('PROGRESS_UPDATE_DELTA', 1.0))
+PROGRESS_STATS = ('downloaded_bytes', 'total_bytes', 'speed', 'eta',
+                  'ingress_allocated_rate', 'ingress_achieved_rate')
+
+# Server-Sent Events progress streams: push at most one event per interval and
+# skip progress moves smaller than the delta; send a comment to keep proxies open
+SSE_MIN_INTERVAL = float(os.environ.get('SSE_MIN_INTERVAL', 0.5))
+SSE_MIN_PROGRESS_DELTA = float(os.environ.get('SSE_MIN_PROGRESS_DELTA', 1.0))
+SSE_KEEPALIVE = float(os.environ.get('SSE_KEEPALIVE', 15))
+
+# Cache extracted metadata so /api/info and /api/download share one extraction.
+# Stream URLs in the info dict expire after a few hours, so keep the TTL short.
+METADATA_CACHE_SIZE = int(os.environ.get('METADATA_CACHE_SIZE', 256))
+METADATA_CACHE_TTL = int(os.environ.get('METADATA_CACHE_TTL', 1800))
+metadata_cache = OrderedDict()  # video_id -> (expires_at, info)
+# Info dict keys neither /api/info nor a download uses; captions, subtitles and
+# thumbnails alone can make up most of a YouTube info dict's size
+UNCACHED_INFO_KEYS = ('automatic_captions', 'subtitles', 'requested_subtitles', 'thumbnails', 'heatmap',
+                      'description', 'tags')
+metadata_cache_lock = threading.Lock()
+
+# Failed extractions are remembered per video ID so retries fail fast: videos
+# that are private, removed, geo-blocked or age-restricted for the long TTL,
+# anything else (bot checks, network errors) for the short one
+NEGATIVE_CACHE_TTL = int(os.environ.get('NEGATIVE_CACHE_TTL', 3600))
+NEGATIVE_CACHE_TTL_TRANSIENT = int(os.environ.get('NEGATIVE_CACHE_TTL_TRANSIENT', 60))
+negative_cache = OrderedDict()  # video_id -> (expires_at, failure class, message)
+
+# YouTube player clients, tried one at a time starting with the most successful
+PLAYER_CLIENTS = [client.strip() for client in os.environ.get('PLAYER_CLIENTS', 'ios,android,web').split(',')
+                  if client.strip()]
+
+# After an HTTP 429 from upstream, stop extracting for a backoff that doubles
+# on every further 429 and resets after a success
+UPSTREAM_BACKOFF = int(os.environ.get('UPSTREAM_BACKOFF', 30))
+UPSTREAM_MAX_BACKOFF = int(os.environ.get('UPSTREAM_MAX_BACKOFF', 900))
+
+# Download scheduling: a fixed pool of workers drains a bounded priority queue
+MAX_CONCURRENT_DOWNLOADS = int(os.environ.get('MAX_CONCURRENT_DOWNLOADS', 4))
+MAX_QUEUED_DOWNLOADS = int(os.environ.get('MAX_QUEUED_DOWNLOADS', 50))
+MAX_DOWNLOADS_PER_CLIENT = int(os.environ.get('MAX_DOWNLOADS_PER_CLIENT', 3))
+QUEUE_RETRY_AFTER = int(os.environ.get('QUEUE_RETRY_AFTER', 30))
+
+# Clients are told apart by IP address (per-client limits, bandwidth shares).
+# Behind reverse proxies, set the number of proxies that append X-Forwarded-For;
+# with 0 the header is ignored, since any caller can set it
+TRUSTED_PROXIES = int(os.environ.get('TRUSTED_PROXIES', 0))
+
+# Where downloads run: `inline` in this process's worker pool, or `worker` in
+# separate worker.py processes that take jobs from the journal (JOURNAL_DB)
+JOB_RUNNER = os.environ.get('JOB_RUNNER', 'inline')
+
+# Batch downloads: playlist expansion limit, items downloaded at once per batch,
+# and their queue priority (below single downloads from the web page)
+BATCH_MAX_ITEMS = int(os.environ.get('BATCH_MAX_ITEMS', 100))
+BATCH_PARALLELISM = int(os.environ.get('BATCH_PARALLELISM', 2))
+MAX_BATCH_PARALLELISM = int(os.environ.get('MAX_BATCH_PARALLELISM', MAX_CONCURRENT_DOWNLOADS))
+BATCH_PRIORITY = -1
+
+# Bandwidth budgets in bytes per second (0 = unlimited): downloads from upstream
+# share INGRESS_BANDWIDTH and file responses share EGRESS_BANDWIDTH, split
+# fairly between client IPs and then between each client's jobs. Allocations
+# follow the rates jobs achieve every interval; a job may burst this many
+# seconds of its rate.
+INGRESS_BANDWIDTH = int(os.environ.get('INGRESS_BANDWIDTH', 0))
+EGRESS_BANDWIDTH = int(os.environ.get('EGRESS_BANDWIDTH', 0))
+BANDWIDTH_REALLOCATE_INTERVAL = float(os.environ.get('BANDWIDTH_REALLOCATE_INTERVAL', 1.0))
+BANDWIDTH_BURST_SECONDS = float(os.environ.get('BANDWIDTH_BURST_SECONDS', 0.5))
+BANDWIDTH_MIN_DEMAND = 64 * 1024
+
+# Format selection: requests may merge a video-only and an audio-only format
+# (ffmpeg stream copy, no re-encoding); MERGE_FORMATS makes that the default
+FFMPEG_AVAILABLE = shutil.which('ffmpeg') is not None
+MERGE_FORMATS = os.environ.get('MERGE_FORMATS', '').lower() in ('1', 'true', 'yes')
+QUALITY_HEIGHTS = {'720p': 720, '480p': 480, '360p': 360, '240p': 240, '144p': 144}
+
+# Containers a finished file can be remuxed to (ffmpeg stream copy, piped to the
+# client at serve time): mode -> ffmpeg muxer, extra arguments, codec prefixes
+# that fit the container (None for any)
+REMUX_FORMATS = {
+    'audio': {
+        'm4a': ('ipod', ['-movflags', 'frag_keyframe+empty_moov'], ('mp4a',)),
+        'opus': ('opus', [], ('opus',)),
+    },
+    'video': {
+        'mp4': ('mp4', ['-movflags', 'frag_keyframe+empty_moov'], None),
+        'mkv': ('matroska', [], None),
+    },
+}
+CONTAINER_MIMETYPES = {
+    'mp4': 'video/mp4', 'm4a': 'audio/mp4', 'webm': 'video/webm', 'mkv': 'video/x-matroska',
+    'opus': 'audio/ogg', 'ogg': 'audio/ogg', 'mp3': 'audio/mpeg', '3gp': 'video/3gpp',
+}
+
+# Fragments of DASH/HLS formats fetched in parallel per download
+CONCURRENT_FRAGMENTS = int(os.environ.get('CONCURRENT_FRAGMENTS', 4))
+MAX_CONCURRENT_FRAGMENTS = int(os.environ.get('MAX_CONCURRENT_FRAGMENTS', 16))
+
+# Idle YoutubeDL handles kept for reuse (extra handles are created under load and discarded)
+YDL_POOL_SIZE = int(os.environ.get('YDL_POOL_SIZE', MAX_CONCURRENT_DOWNLOADS + 4))
+
+# Extractors each YoutubeDL handle loads: 'youtube' registers only YouTube's
+# (faster handle creation); 'all' also serves other sites
+EXTRACTORS = os.environ.get('EXTRACTORS', 'all')
+
+# Each job downloads into its own directory, removed in one step afterwards
+JOBS_DIR = os.environ.get('JOBS_DIR', os.path.join(DOWNLOAD_DIR, 'youtube-downloader-jobs'))
+
+# Finished downloads are kept in a size-capped LRU cache keyed by (video ID, format ID)
+CACHE_DIR = os.environ.get('CACHE_DIR', os.path.join(DOWNLOAD_DIR, 'youtube-downloader-cache'))
+CACHE_MAX_BYTES = int(os.environ.get('CACHE_MAX_BYTES', 10 * 1024 ** 3))
+
+# Streaming a download while it is still in progress: bytes are read from the
+# growing file in chunks, only as fast as the client consumes them
+STREAM_CHUNK_SIZE = int(os.environ.get('STREAM_CHUNK_SIZE', 256 * 1024))
+STREAM_START_TIMEOUT = float(os.environ.get('STREAM_START_TIMEOUT', 120))
+STREAM_POLL_INTERVAL = float(os.environ.get('STREAM_POLL_INTERVAL', 0.5))
+
+# Keep a job's record this long after it completes or its last file transfer
+# closes, so that interrupted downloads can be resumed with a Range request
+FILE_LINGER_SECONDS = int(os.environ.get('FILE_LINGER_SECONDS', 600))
+
+# Background janitor: how often it runs, how long failed, stalled and batch
+# records are kept, when an abandoned job directory counts as stale, and the
+# disk usage (fraction of the volume) above which cached files are evicted
+JANITOR_INTERVAL = int(os.environ.get('JANITOR_INTERVAL', 60))
+JOB_TTL_ERROR = int(os.environ.get('JOB_TTL_ERROR', 600))
+JOB_TTL_ACTIVE = int(os.environ.get('JOB_TTL_ACTIVE', 6 * 3600))
+JOB_TTL_BATCH = int(os.environ.get('JOB_TTL_BATCH', 24 * 3600))
+STALE_PART_SECONDS = int(os.environ.get('STALE_PART_SECONDS', 3600))
+DISK_HIGH_WATER = float(os.environ.get('DISK_HIGH_WATER', 0.90))
+DISK_LOW_WATER = float(os.environ.get('DISK_LOW_WATER', 0.80))
+
+# Finished jobs stay in the journal as long as any of their records may be kept
+JOURNAL_RETENTION = max(FILE_LINGER_SECONDS, JOB_TTL_ERROR, JOB_TTL_BATCH)
+
+if TRUSTED_PROXIES:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXIES)
+
+YOUTUBE_ID_RE = re.compile(
+    r'(?:youtube(?:-nocookie)?\.com/(?:watch\?(?:.*&)?v=|shorts/|embed/|live/|v/)|youtu\.be/)'
+    r'([0-9A-Za-z_-]{11})'
+)
+
+
+def format_labels(labels):
+    """Render a label set (sorted name/value pairs) in Prometheus text format"""
+    if not labels:
+        return ''
+    pairs = ('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+             for name, value in labels)
+    return '{' + ','.join(pairs) + '}'
+
+
+class Counter:
+    """Monotonic counter, optionally split by labels"""
+
+    kind = 'counter'
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, key, value) for key, value in self._values.items()]
+
+
+class Gauge:
+    """Value computed at scrape time by a callback returning {labels: value}"""
+
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, callback):
+        self.name = name
+        self.help = help_text
+        self.callback = callback
+
+    def samples(self):
+        return [(self.name, tuple(sorted(labels)), value) for labels, value in self.callback().items()]
+
+
+class Histogram:
+    """Distribution of observed values over fixed buckets"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, buckets):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(buckets)
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = 0
+        while index < len(self.buckets) and value > self.buckets[index]:
+            index += 1
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+
+    @contextlib.contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def samples(self):
+        with self._lock:
+            counts, total = list(self._counts), self._sum
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else repr(float(bound))
+            samples.append((self.name + '_bucket', (('le', le),), cumulative))
+        samples.append((self.name + '_sum', (), total))
+        samples.append((self.name + '_count', (), cumulative))
+        return samples
+
+
+class MetricsRegistry:
+    """Minimal Prometheus registry; metrics are per process"""
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for name, labels, value in metric.samples():
+                lines.append(f'{name}{format_labels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics = MetricsRegistry()
+extraction_seconds = metrics.register(Histogram(
+    'ytdl_extraction_seconds', 'Time spent in yt-dlp metadata extraction',
+    (0.25, 0.5, 1, 2, 3, 5, 8, 13, 20, 30, 60)))
+downloaded_bytes_total = metrics.register(Counter(
+    'ytdl_downloaded_bytes_total', 'Bytes downloaded from upstream'))
+cache_lookups_total = metrics.register(Counter(
+    'ytdl_cache_lookups_total', 'Cache lookups by cache and result'))
+progress_lock_wait_seconds = metrics.register(Counter(
+    'ytdl_progress_lock_wait_seconds_total', 'Time spent waiting to acquire progress_lock'))
+progress_lock_acquisitions = metrics.register(Counter(
+    'ytdl_progress_lock_acquisitions_total', 'Number of progress_lock acquisitions'))
+served_bytes_total = metrics.register(Counter(
+    'ytdl_served_bytes_total', 'Response body bytes sent to clients, by endpoint'))
+errors_total = metrics.register(Counter(
+    'ytdl_errors_total', 'Failed extractions and downloads, by stage and exception class'))
+clip_bytes_saved_total = metrics.register(Counter(
+    'ytdl_clip_bytes_saved_total', 'Estimated bytes not downloaded because only a clip was requested'))
+cookie_session_failures_total = metrics.register(Counter(
+    'ytdl_cookie_session_failures_total', 'Failures that put a cookie session in cooldown, by session and class'))
+
+
+@contextlib.contextmanager
+def timed_progress_lock():
+    """Hold progress_lock, recording how long acquiring it took"""
+    start = time.perf_counter()
+    with progress_lock:
+        progress_lock_wait_seconds.inc(time.perf_counter() - start)
+        progress_lock_acquisitions.inc()
+        yield
+
+
+def error_class(exc):
+    """Name of the exception behind a failure, unwrapping yt-dlp's DownloadError"""
+    if isinstance(exc, yt_dlp.utils.DownloadError) and exc.exc_info and exc.exc_info[1]:
+        exc = exc.exc_info[1]
+    return type(exc).__name__
+
+
+class ProgressStore:
+    """Job state shared by the download workers and the API routes"""
+
+    def set(self, download_id, record):
+        raise NotImplementedError
+
+    def get(self, download_id):
+        """Return the job record, or None if the job is unknown"""
+        raise NotImplementedError
+
+    def delete(self, download_id):
+        raise NotImplementedError
+
+    def records(self):
+        """Return (download_id, record) pairs for every job"""
+        raise NotImplementedError
+
+    def wait_for_change(self, download_id, last, timeout):
+        """Block until the record differs from `last` or `timeout` expires, then return it"""
+        deadline = time.monotonic() + timeout
+        while True:
+            record = self.get(download_id)
+            remaining = deadline - time.monotonic()
+            if record != last or remaining <= 0:
+                return record
+            time.sleep(min(0.25, remaining))
+
+
+class _JobSlot:
+    """Latest record of one job plus a condition to wake its stream readers"""
+
+    __slots__ = ('record', 'changed')
+
+    def __init__(self):
+        self.record = None
+        self.changed = threading.Condition(threading.Lock())
+
+
+class MemoryProgressStore(ProgressStore):
+    """Process-local store; only correct with a single gunicorn worker
+
+    Each job has its own slot, so progress_lock is only taken to add or remove
+    a slot. Records are replaced, never mutated, which makes reads lock-free.
+    """
+
+    def __init__(self):
+        self._slots = {}
+
+    def _slot(self, download_id):
+        slot = self._slots.get(download_id)
+        if slot is None:
+            with timed_progress_lock():
+                slot = self._slots.setdefault(download_id, _JobSlot())
+        return slot
+
+    def set(self, download_id, record):
+        slot = self._slot(download_id)
+        with slot.changed:
+            slot.record = record
+            slot.changed.notify_all()
+
+    def get(self, download_id):
+        slot = self._slots.get(download_id)
+        record = slot.record if slot else None
+        return dict(record) if record else None
+
+    def delete(self, download_id):
+        with timed_progress_lock():
+            slot = self._slots.pop(download_id, None)
+        if slot:
+            with slot.changed:
+                slot.record = None
+                slot.changed.notify_all()
+
+    def records(self):
+        return [(download_id, dict(slot.record))
+                for download_id, slot in list(self._slots.items()) if slot.record]
+
+    def wait_for_change(self, download_id, last, timeout):
+        slot = self._slots.get(download_id)
+        if slot is None:
+            return None
+        with slot.changed:
+            slot.changed.wait_for(lambda: slot.record != last, timeout)
+            return dict(slot.record) if slot.record else None
+
+
+def sqlite_connection(local, path, synchronous):
+    """This thread's connection to a WAL-mode database (connections can't cross threads or a fork)"""
+    conn = getattr(local, 'conn', None)
+    if conn is None or local.pid != os.getpid():
+        conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute(f'PRAGMA synchronous={synchronous}')
+        local.conn = conn
+        local.pid = os.getpid()
+    return conn
+
+
+class SqliteProgressStore(ProgressStore):
+    """Store shared by every process on the host through SQLite in WAL mode"""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._connect().execute(
+            'CREATE TABLE IF NOT EXISTS progress ('
+            'download_id TEXT PRIMARY KEY, record TEXT NOT NULL, updated REAL NOT NULL)'
+        )
+
+    def _connect(self):
+        return sqlite_connection(self._local, self.path, 'NORMAL')
+
+    def set(self, download_id, record):
+        self._connect().execute(
+            'INSERT OR REPLACE INTO progress (download_id, record, updated) VALUES (?, ?, ?)',
+            (download_id, json.dumps(record), time.time())
+        )
+
+    def get(self, download_id):
+        row = self._connect().execute(
+            'SELECT record FROM progress WHERE download_id = ?', (download_id,)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def delete(self, download_id):
+        self._connect().execute('DELETE FROM progress WHERE download_id = ?', (download_id,))
+
+    def records(self):
+        rows = self._connect().execute('SELECT download_id, record FROM progress').fetchall()
+        return [(download_id, json.loads(record)) for download_id, record in rows]
+
+
+def create_progress_store():
+    """Build the progress store selected by PROGRESS_STORE"""
+    if PROGRESS_STORE == 'sqlite':
+        return SqliteProgressStore(PROGRESS_DB)
+    if PROGRESS_STORE != 'memory':
+        raise ValueError(f"Unknown PROGRESS_STORE: {PROGRESS_STORE}")
+    if JOB_RUNNER == 'worker':
+        raise ValueError("JOB_RUNNER=worker needs PROGRESS_STORE=sqlite to see the workers' progress")
+    return MemoryProgressStore()
+
+
+progress_store = create_progress_store()
+job_followers = {}  # leader download_id -> download_ids attached to its download
+job_outputs = {}  # download_id -> its own output fields, kept when it follows another job
+
+
+HOSTNAME = socket.gethostname()
+
+
+def process_token(pid=None):
+    """Identify a live process by host, PID and start time, so a reused PID does not match"""
+    pid = pid or os.getpid()
+    try:
+        with open(f'/proc/{pid}/stat') as stat:
+            start_time = stat.read().rsplit(')', 1)[1].split()[19]
+    except OSError:
+        return None if pid != os.getpid() else f'{HOSTNAME}:{pid}:'
+    return f'{HOSTNAME}:{pid}:{start_time}'
+
+
+def owner_alive(owner):
+    """Whether the process behind a process_token may still be running
+
+    Only processes on this host can be checked; owners on other hosts count
+    as alive. Without /proc, a process counts as alive while its PID exists.
+    """
+    host, pid, start_time = owner.rsplit(':', 2) if owner.count(':') > 1 else (HOSTNAME, *owner.split(':'))
+    if host != HOSTNAME:
+        return True
+    token = process_token(int(pid))
+    if token is not None:
+        return token.rsplit(':', 1)[1] == start_time
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class JobJournal:
+    """Durable record of submitted jobs, shared by every process on the host
+
+    Each job row is written on submission and on every state change (queued,
+    running, completed, error) with synchronous=FULL, and remembers the
+    process that owns it. After a restart, unfinished jobs whose owner is
+    gone are claimed in one transaction, so each is resumed exactly once.
+
+    With JOB_RUNNER=worker it also carries the failure cache and the upstream
+    backoff, so the front-end refuses what the workers found failing.
+    """
+
+    UNFINISHED = ('queued', 'running')
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._connect().execute(
+            'CREATE TABLE IF NOT EXISTS jobs ('
+            'download_id TEXT PRIMARY KEY, kind TEXT NOT NULL, parent TEXT, request TEXT NOT NULL, '
+            'state TEXT NOT NULL, record TEXT, owner TEXT, updated REAL NOT NULL)'
+        )
+        self._connect().execute(
+            'CREATE TABLE IF NOT EXISTS failures ('
+            'video_id TEXT PRIMARY KEY, expires_at REAL NOT NULL, failure TEXT NOT NULL, message TEXT NOT NULL)'
+        )
+        self._connect().execute(
+            'CREATE TABLE IF NOT EXISTS upstream (id INTEGER PRIMARY KEY CHECK (id = 0), paused_until REAL NOT NULL)'
+        )
+
+    def _connect(self):
+        return sqlite_connection(self._local, self.path, 'FULL')
+
+    def submit(self, jobs):
+        """Record new (download_id, kind, parent, request) jobs in one transaction"""
+        conn = self._connect()
+        owner, now = process_token(), time.time()
+        with conn:
+            conn.execute('BEGIN')
+            conn.executemany(
+                'INSERT OR REPLACE INTO jobs (download_id, kind, parent, request, state, owner, updated) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                [(download_id, kind, parent, json.dumps(request), 'queued', owner, now)
+                 for download_id, kind, parent, request in jobs])
+
+    def set_state(self, download_id, state, record=None):
+        self._connect().execute(
+            'UPDATE jobs SET state = ?, record = COALESCE(?, record), updated = ? WHERE download_id = ?',
+            (state, json.dumps(record) if record is not None else None, time.time(), download_id))
+
+    def state(self, download_id):
+        row = self._connect().execute('SELECT state FROM jobs WHERE download_id = ?', (download_id,)).fetchone()
+        return row[0] if row else None
+
+    def request(self, download_id):
+        row = self._connect().execute('SELECT request FROM jobs WHERE download_id = ?', (download_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def admit(self, client, jobs=1):
+        """Raise QueueFull unless `jobs` more jobs from `client` fit the workers' queue
+
+        Like DownloadScheduler.admit, batch items only count while running.
+        """
+        queued, client_jobs = self._connect().execute(
+            "SELECT COALESCE(SUM(state = 'queued'), 0), COALESCE(SUM(json_extract(request, '$.client') = ?), 0) "
+            "FROM jobs WHERE state IN (?, ?) AND (kind = 'download' OR state = 'running')",
+            (client,) + self.UNFINISHED).fetchone()
+        if queued + jobs > MAX_QUEUED_DOWNLOADS:
+            raise QueueFull('Download queue is full, please retry later')
+        if client is not None and client_jobs >= MAX_DOWNLOADS_PER_CLIENT:
+            raise QueueFull('Too many downloads in progress for this client')
+
+    def count(self, state):
+        return self._connect().execute('SELECT COUNT(*) FROM jobs WHERE state = ?', (state,)).fetchone()[0]
+
+    def claim_next(self):
+        """Take the next queued job for this worker process, or None
+
+        Single downloads go before batch items, and a batch never has more
+        items running than its parallelism. Items of a batch missing from the
+        journal are claimed too, so that the caller fails them.
+        """
+        conn = self._connect()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            running = dict(conn.execute(
+                "SELECT parent, COUNT(*) FROM jobs WHERE kind = 'batch_item' AND state = 'running' "
+                "GROUP BY parent").fetchall())
+            queued = conn.execute(
+                "SELECT download_id, kind, parent, request FROM jobs WHERE state = 'queued' "
+                "ORDER BY kind = 'batch_item', rowid").fetchall()
+            for download_id, kind, parent, request in queued:
+                batch = self.request(parent) if kind == 'batch_item' else None
+                if batch and running.get(parent, 0) >= batch['parallelism']:
+                    continue
+                conn.execute('UPDATE jobs SET state = ?, owner = ?, updated = ? WHERE download_id = ?',
+                             ('running', process_token(), time.time(), download_id))
+                return download_id, kind, parent, json.loads(request)
+        return None
+
+    def requeue_orphaned(self):
+        """Put jobs back in the queue whose worker died while running them"""
+        conn = self._connect()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            rows = conn.execute("SELECT download_id, owner FROM jobs WHERE state = 'running'").fetchall()
+            orphaned = [download_id for download_id, owner in rows if not owner_alive(owner)]
+            conn.executemany("UPDATE jobs SET state = 'queued' WHERE download_id = ?",
+                             [(download_id,) for download_id in orphaned])
+        return len(orphaned)
+
+    def claim_unfinished(self):
+        """Take over unfinished jobs of processes that no longer exist"""
+        conn = self._connect()
+        me = process_token()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            rows = conn.execute(
+                'SELECT download_id, kind, parent, request, owner FROM jobs WHERE state IN (?, ?) ORDER BY rowid',
+                self.UNFINISHED).fetchall()
+            orphaned = [row for row in rows if row[4] != me and not owner_alive(row[4])]
+            conn.executemany('UPDATE jobs SET owner = ? WHERE download_id = ?',
+                             [(me, row[0]) for row in orphaned])
+        return [(download_id, kind, parent, json.loads(request))
+                for download_id, kind, parent, request, _ in orphaned]
+
+    def finished(self, since):
+        """(download_id, kind, record) of jobs with a final record written after `since`"""
+        rows = self._connect().execute(
+            'SELECT download_id, kind, record FROM jobs WHERE record IS NOT NULL AND updated >= ?',
+            (since,)).fetchall()
+        return [(download_id, kind, json.loads(record)) for download_id, kind, record in rows]
+
+    def prune(self, before):
+        """Forget finished jobs last updated before `before`, and expired failures
+
+        A batch stays while any of its items is unfinished; they need its settings.
+        """
+        conn = self._connect()
+        conn.execute(
+            'DELETE FROM jobs WHERE state NOT IN (?, ?) AND updated < ? AND NOT EXISTS ('
+            'SELECT 1 FROM jobs AS item WHERE item.parent = jobs.download_id AND item.state IN (?, ?))',
+            self.UNFINISHED + (before,) + self.UNFINISHED)
+        conn.execute('DELETE FROM failures WHERE expires_at < ?', (time.time(),))
+
+    def remember_failure(self, video_id, expires_at, failure, message):
+        self._connect().execute(
+            'INSERT OR REPLACE INTO failures (video_id, expires_at, failure, message) VALUES (?, ?, ?, ?)',
+            (video_id, expires_at, failure, message))
+
+    def failure(self, video_id):
+        """(expires_at, failure class, message) of a video's unexpired failure, or None"""
+        return self._connect().execute(
+            'SELECT expires_at, failure, message FROM failures WHERE video_id = ? AND expires_at >= ?',
+            (video_id, time.time())).fetchone()
+
+    def pause_upstream(self, until):
+        self._connect().execute(
+            'INSERT INTO upstream (id, paused_until) VALUES (0, ?) '
+            'ON CONFLICT (id) DO UPDATE SET paused_until = MAX(paused_until, excluded.paused_until)', (until,))
+
+    def upstream_paused_until(self):
+        row = self._connect().execute('SELECT paused_until FROM upstream WHERE id = 0').fetchone()
+        return row[0] if row else 0
+
+
+journal = JobJournal(JOURNAL_DB)
+
+
+def update_progress(download_id, progress, status='downloading', filepath=None, error_msg=None,
+                    queue_position=None, stats=None):
+    """Update download progress"""
+    record = {
+        'progress': progress,
+        'status': status,
+        'timestamp': time.time()
+    }
+    if error_msg:
+        record['error'] = error_msg
+    if queue_position is not None:
+        record['queue_position'] = queue_position
+    if filepath:
+        record['filepath'] = filepath
+    if stats:
+        record.update(stats)
+    progress_store.set(download_id, record)
+    # Jobs attached to this one by the download cache see the same progress
+    for follower in job_followers.get(download_id, ()):
+        progress_store.set(follower, dict(record, **job_outputs.get(follower, {})))
+
+
+class QueueFull(Exception):
+    """Raised when the scheduler cannot admit another download"""
+
+    def __init__(self, message, retry_after=QUEUE_RETRY_AFTER):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class DownloadScheduler:
+    """Fixed-size worker pool fed by a bounded priority queue of download jobs"""
+
+    def __init__(self, workers, max_queued, max_per_client):
+        self.workers = workers
+        self.max_queued = max_queued
+        self.max_per_client = max_per_client
+        self.active = 0
+        self._heap = []  # (-priority, seq, download_id, client, func)
+        self._seq = itertools.count()
+        self._client_jobs = {}  # client -> number of queued and running jobs
+        self._cond = threading.Condition()
+        self._threads = []
+
+    def admit(self, client=None, jobs=1):
+        """Raise QueueFull unless `jobs` more jobs from `client` fit"""
+        with self._cond:
+            if len(self._heap) + jobs > self.max_queued:
+                raise QueueFull('Download queue is full, please retry later')
+            if client is not None and self._client_jobs.get(client, 0) >= self.max_per_client:
+                raise QueueFull('Too many downloads in progress for this client')
+
+    def submit(self, download_id, func, client=None, priority=0, enforce_limits=True):
+        """Queue a job; higher priority runs first, FIFO within a priority
+
+        Jobs of an already admitted batch pass enforce_limits=False.
+        """
+        with self._cond:
+            if enforce_limits:
+                self.admit(client)
+            heapq.heappush(self._heap, (-priority, next(self._seq), download_id, client, func))
+            if client is not None:
+                self._client_jobs[client] = self._client_jobs.get(client, 0) + 1
+            # Start workers lazily so they are not lost across a gunicorn fork
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._worker, daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            self._cond.notify()
+            self._publish_positions()
+
+    def queue_depth(self):
+        """Number of jobs waiting for a worker"""
+        with self._cond:
+            return len(self._heap)
+
+    def _publish_positions(self):
+        # Called with the condition held so a position can't overwrite a started job
+        for position, entry in enumerate(sorted(self._heap), start=1):
+            update_progress(entry[2], 0, 'queued', queue_position=position)
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while not self._heap:
+                    self._cond.wait()
+                _, _, download_id, client, func = heapq.heappop(self._heap)
+                self.active += 1
+                self._publish_positions()
+            try:
+                func()
+            except Exception:
+                app.logger.exception('Download job %s failed', download_id)
+            finally:
+                with self._cond:
+                    self.active -= 1
+                    if client is not None:
+                        self._client_jobs[client] -= 1
+                        if not self._client_jobs[client]:
+                            del self._client_jobs[client]
+
+
+scheduler = DownloadScheduler(MAX_CONCURRENT_DOWNLOADS, MAX_QUEUED_DOWNLOADS, MAX_DOWNLOADS_PER_CLIENT)
+
+
+def water_fill(capacity, demands):
+    """Max-min fair split of `capacity` between keys with the given demands
+
+    A demand of None means "as much as it gets". Keys asking for less than an
+    equal share get their demand and the rest is split among the others;
+    whatever is left once every demand is met is shared out as headroom.
+    """
+    shares = {}
+    pending = dict(demands)
+    while pending:
+        equal = capacity / len(pending)
+        modest = {key: demand for key, demand in pending.items() if demand is not None and demand < equal}
+        if not modest:
+            shares.update(dict.fromkeys(pending, equal))
+            return shares
+        for key, demand in modest.items():
+            shares[key] = demand
+            capacity -= demand
+            del pending[key]
+    for key in shares:
+        shares[key] += capacity / len(shares)
+    return shares
+
+
+class BandwidthFlow:
+    """One job's or one response's share of a budget, enforced as a token bucket"""
+
+    def __init__(self, budget, job, client, on_change=None):
+        self.budget = budget
+        self.job = job
+        self.client = client
+        self.on_change = on_change
+        self.rate = 0.0  # allocated bytes per second
+        self.achieved = None  # smoothed measured bytes per second
+        self._tokens = 0.0
+        self._updated = self._window_start = time.monotonic()
+        self._window_bytes = 0
+        self._lock = threading.Lock()
+
+    def demand(self):
+        """What the flow could use: a little more than it achieves, unknown until measured"""
+        if self.achieved is None:
+            return None
+        return max(self.achieved * 1.25, BANDWIDTH_MIN_DEMAND)
+
+    def set_rate(self, rate):
+        with self._lock:
+            changed = int(rate) != int(self.rate)
+            self.rate = rate
+        if changed and self.on_change:
+            self.on_change(int(rate))
+
+    def measure(self, now):
+        with self._lock:
+            elapsed = now - self._window_start
+            if elapsed <= 0:
+                return
+            rate = self._window_bytes / elapsed
+            self.achieved = rate if self.achieved is None else (self.achieved + rate) / 2
+            self._window_start = now
+            self._window_bytes = 0
+
+    def consume(self, nbytes):
+        """Account for nbytes and sleep long enough to keep to the allocated rate"""
+        with self._lock:
+            now = time.monotonic()
+            rate = self.rate
+            # A chunk bigger than the burst (yt-dlp reads up to a second's worth)
+            # is fine once the time since the last one has paid for it
+            self._tokens = min(self._tokens + (now - self._updated) * rate,
+                               max(rate * BANDWIDTH_BURST_SECONDS, nbytes)) - nbytes
+            self._updated = now
+            self._window_bytes += nbytes
+            wait = -self._tokens / rate if self._tokens < 0 and rate > 0 else 0
+        self.budget.tick()
+        if wait > 0:
+            time.sleep(wait)
+
+
+class BandwidthBudget:
+    """Bandwidth of one direction, shared max-min fairly by client IP, then by flow
+
+    Allocations are recomputed when a flow joins or leaves, and every
+    BANDWIDTH_REALLOCATE_INTERVAL from the rates flows actually achieve, so
+    bandwidth that a slow or idle flow can't use goes to the others.
+    """
+
+    def __init__(self, name, rate):
+        self.name = name
+        self.rate = rate
+        self._flows = set()
+        self._lock = threading.Lock()
+        self._reallocated = time.monotonic()
+
+    def join(self, job, client, on_change=None):
+        """Start a flow for `job`; returns None when the budget is unlimited"""
+        if not self.rate:
+            return None
+        flow = BandwidthFlow(self, job, client, on_change)
+        with self._lock:
+            self._flows.add(flow)
+            self._reallocate()
+        return flow
+
+    def leave(self, flow):
+        with self._lock:
+            if flow not in self._flows:
+                return
+            self._flows.discard(flow)
+            self._reallocate()
+
+    def tick(self):
+        """Follow achieved rates once per interval (called as flows move bytes)"""
+        now = time.monotonic()
+        if now - self._reallocated < BANDWIDTH_REALLOCATE_INTERVAL:
+            return
+        with self._lock:
+            if now - self._reallocated < BANDWIDTH_REALLOCATE_INTERVAL:
+                return
+            for flow in self._flows:
+                flow.measure(now)
+            self._reallocate()
+
+    def _reallocate(self):
+        self._reallocated = time.monotonic()
+        by_client = {}
+        for flow in self._flows:
+            by_client.setdefault(flow.client, []).append(flow)
+        client_demands = {}
+        for client, flows in by_client.items():
+            demands = [flow.demand() for flow in flows]
+            client_demands[client] = None if None in demands else sum(demands)
+        for client, share in water_fill(self.rate, client_demands).items():
+            flows = by_client[client]
+            for flow, rate in water_fill(share, {flow: flow.demand() for flow in flows}).items():
+                flow.set_rate(rate)
+
+    def job_rates(self, job):
+        """Allocated and achieved rates of a job's flows in this process"""
+        with self._lock:
+            flows = [flow for flow in self._flows if flow.job == job]
+        if not flows:
+            return {}
+        achieved = [flow.achieved for flow in flows if flow.achieved is not None]
+        return {
+            f'{self.name}_allocated_rate': int(sum(flow.rate for flow in flows)),
+            f'{self.name}_achieved_rate': int(sum(achieved)) if achieved else None,
+        }
+
+
+ingress_budget = BandwidthBudget('ingress', INGRESS_BANDWIDTH)
+egress_budget = BandwidthBudget('egress', EGRESS_BANDWIDTH)
+
+
+class ThrottledBody:
+    """Response body that paces another body's chunks through an egress flow"""
+
+    def __init__(self, body, flow):
+        self.body = body
+        self.flow = flow
+
+    def __iter__(self):
+        for chunk in self.body:
+            self.flow.consume(len(chunk))
+            yield chunk
+
+    def close(self):
+        try:
+            close = getattr(self.body, 'close', None)
+            if close:
+                close()
+        finally:
+            egress_budget.leave(self.flow)
+
+
+def throttle_response(response, download_id):
+    """Send a response body within the requesting client's egress share"""
+    if response.status_code == 304 or request.method == 'HEAD':
+        return response
+    flow = egress_budget.join(download_id, request.remote_addr)
+    if flow is not None:
+        response.response = ThrottledBody(response.response, flow)
+    return response
+
+
+class DownloadCache:
+    """Size-capped LRU cache of finished downloads, keyed by (video ID, format ID)
+
+    Files are named after a digest of the key, so identical requests map to the
+    same file. claim() also deduplicates concurrent requests: the first job for
+    a key downloads it and later jobs attach to it until it is stored. Files
+    pinned by an open transfer in this process, or returned by `in_use` (files
+    other processes may be serving), are never evicted.
+    """
+
+    def __init__(self, directory, max_bytes, in_use=set):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.in_use = in_use
+        self.lock = threading.Lock()
+        self._entries = OrderedDict()  # path -> size, least recently used first
+        self._inflight = {}  # key -> download_id of the job downloading it
+        self._pins = {}  # path -> number of open transfers
+        os.makedirs(directory, exist_ok=True)
+        self.rescan()
+
+    def rescan(self):
+        """Rebuild the index from disk, oldest access first
+
+        Other processes add and evict files too, so the janitor calls this
+        periodically to keep the size accounting honest.
+        """
+        files = []
+        for entry in os.scandir(self.directory):
+            if not entry.is_file():
+                continue
+            stat = entry.stat()
+            if entry.name.startswith('.'):
+                # Temporary copy of store(); left behind only if its process died
+                if time.time() - stat.st_mtime > STALE_PART_SECONDS:
+                    with contextlib.suppress(OSError):
+                        os.remove(entry.path)
+                continue
+            files.append((stat.st_atime, entry.path, stat.st_size))
+        with self.lock:
+            self._entries = OrderedDict((path, size) for _, path, size in sorted(files))
+
+    def path_for(self, key, ext):
+        """Path of the cache file for a (video ID, format ID) key"""
+        digest = hashlib.sha256('/'.join(key).encode('utf-8')).hexdigest()[:32]
+        return os.path.join(self.directory, f'{digest}.{ext}')
+
+    def claim(self, key, ext, download_id):
+        """Return ('hit', path), ('follower', leader_id) or ('leader', None)"""
+        path = self.path_for(key, ext)
+        with self.lock:
+            if os.path.exists(path):
+                self._entries[path] = os.path.getsize(path)
+                self._entries.move_to_end(path)
+                # Persist recency in atime only; mtime backs Last-Modified
+                os.utime(path, (time.time(), os.stat(path).st_mtime))
+                cache_lookups_total.inc(cache='file', result='hit')
+                return 'hit', path
+            leader = self._inflight.get(key)
+            if leader:
+                # Seed the follower's record before it is attached; the leader's
+                # final update comes after release(), which waits for this lock
+                leader_record = progress_store.get(leader)
+                if leader_record:
+                    progress_store.set(download_id, dict(leader_record, **job_outputs.get(download_id, {})))
+                job_followers.setdefault(leader, []).append(download_id)
+                cache_lookups_total.inc(cache='file', result='follower')
+                return 'follower', leader
+            self._inflight[key] = download_id
+            cache_lookups_total.inc(cache='file', result='miss')
+            return 'leader', None
+
+    def release(self, key):
+        """Stop attaching new jobs to the in-flight download of `key`"""
+        with self.lock:
+            self._inflight.pop(key, None)
+
+    def store(self, key, ext, src):
+        """Move a finished download into the cache and return its cache path
+
+        Across filesystems the move is a copy, so it goes to a hidden temporary
+        name first: claim() must never see a partly written file.
+        """
+        path = self.path_for(key, ext)
+        tmp = os.path.join(self.directory, f'.{uuid.uuid4().hex}.tmp')
+        shutil.move(src, tmp)
+        os.replace(tmp, path)
+        with self.lock:
+            self._entries[path] = os.path.getsize(path)
+            self._entries.move_to_end(path)
+            self._evict(self.max_bytes)
+        return path
+
+    def pin(self, path):
+        """Protect a file from eviction while it is being served"""
+        with self.lock:
+            self._pins[path] = self._pins.get(path, 0) + 1
+
+    def unpin(self, path):
+        with self.lock:
+            self._pins[path] -= 1
+            if not self._pins[path]:
+                del self._pins[path]
+            self._evict(self.max_bytes)
+
+    def total_bytes(self):
+        with self.lock:
+            return sum(self._entries.values())
+
+    def shrink(self, nbytes):
+        """Evict least recently used files until `nbytes` have been freed"""
+        with self.lock:
+            self._evict(sum(self._entries.values()) - nbytes)
+
+    def _evict(self, limit):
+        total = sum(self._entries.values())
+        if total <= limit:
+            return
+        in_use = self.in_use()
+        # Never evict the newest entry, even if it alone exceeds the cap
+        newest = next(reversed(self._entries), None)
+        for path in list(self._entries):
+            if total <= limit:
+                break
+            if path in self._pins or path in in_use or path == newest:
+                continue
+            total -= self._entries.pop(path)
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def served_files():
+    """Files of completed jobs whose records are live, which any process may be serving"""
+    return {record['filepath'] for _, record in progress_store.records()
+            if record.get('status') == 'completed' and record.get('filepath')}
+
+
+download_cache = DownloadCache(CACHE_DIR, CACHE_MAX_BYTES, served_files)
+
+# Open file transfers per job in this process. The janitor never expires a job
+# while one is open, and refreshes the record of each so other processes don't
+active_transfers = {}
+transfers_lock = threading.Lock()
+
+
+def touch_record(download_id):
+    """Restart a completed job's linger period in the (possibly shared) store"""
+    record = progress_store.get(download_id)
+    if record and record.get('status') == 'completed':
+        record['timestamp'] = time.time()
+        progress_store.set(download_id, record)
+
+
+def transfer_started(download_id, filepath):
+    """Pin a job's file and record while a response is streaming it"""
+    download_cache.pin(filepath)
+    with transfers_lock:
+        active_transfers[download_id] = active_transfers.get(download_id, 0) + 1
+    touch_record(download_id)
+
+
+def transfer_finished(download_id, filepath):
+    """Release a transfer; the job's linger period restarts when the last one closes"""
+    download_cache.unpin(filepath)
+    with transfers_lock:
+        active_transfers[download_id] -= 1
+        if active_transfers[download_id]:
+            return
+        del active_transfers[download_id]
+    touch_record(download_id)
+
+
+def release_on_close(response, callback):
+    """Run `callback` once when the WSGI server closes the response body
+
+    send_file responses use direct passthrough (so servers can sendfile), which
+    bypasses Response.call_on_close; wrap the body's close() instead.
+    """
+    body = response.response
+    close = getattr(body, 'close', None)
+    released = []
+    
+    def close_body():
+        try:
+            if close:
+                close()
+        finally:
+            if not released:
+                released.append(True)
+                callback()
+    
+    body.close = close_body
+
+
+class Janitor:
+    """Single background thread that expires job records and reclaims disk space"""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Start the thread once per process (gunicorn forks after import)"""
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.run_once()
+            except Exception:
+                app.logger.exception('Janitor pass failed')
+
+    def run_once(self):
+        self.refresh_transfers()
+        self.expire_jobs()
+        self.remove_stale_job_dirs()
+        self.enforce_disk_quota()
+        journal.prune(time.time() - JOURNAL_RETENTION)
+        if JOB_RUNNER == 'worker':
+            journal.requeue_orphaned()
+
+    def refresh_transfers(self):
+        """Heartbeat: keep the records of jobs this process is serving from expiring elsewhere"""
+        with transfers_lock:
+            serving = list(active_transfers)
+        for download_id in serving:
+            touch_record(download_id)
+
+    def expire_jobs(self):
+        """Drop job records whose TTL for their current state has passed"""
+        now = time.time()
+        for download_id, record in progress_store.records():
+            status = record.get('status')
+            if status == 'completed':
+                ttl = FILE_LINGER_SECONDS
+            elif status == 'error':
+                ttl = JOB_TTL_ERROR
+            elif status == 'batch':
+                ttl = JOB_TTL_BATCH
+            else:
+                ttl = JOB_TTL_ACTIVE
+            if now - record.get('timestamp', 0) < ttl:
+                continue
+            with transfers_lock:
+                if active_transfers.get(download_id):
+                    continue
+            progress_store.delete(download_id)
+
+    def remove_stale_job_dirs(self):
+        """Remove .part files left behind by jobs that are gone or finished"""
+        if not os.path.isdir(JOBS_DIR):
+            return
+        now = time.time()
+        for entry in os.scandir(JOBS_DIR):
+            if not entry.is_dir() or now - entry.stat().st_mtime < STALE_PART_SECONDS:
+                continue
+            record = progress_store.get(entry.name)
+            if record and record.get('status') not in ('completed', 'error'):
+                continue
+            # A job interrupted by a restart resumes from its .part files
+            if journal.state(entry.name) in JobJournal.UNFINISHED:
+                continue
+            shutil.rmtree(entry.path, ignore_errors=True)
+
+    def enforce_disk_quota(self):
+        """Evict cached files (LRU) once the volume passes the high-water mark"""
+        download_cache.rescan()
+        usage = shutil.disk_usage(CACHE_DIR)
+        if usage.used / usage.total < DISK_HIGH_WATER:
+            return
+        to_free = usage.used - DISK_LOW_WATER * usage.total
+        app.logger.warning('Disk %.0f%% full, evicting %d bytes from the download cache',
+                           100 * usage.used / usage.total, to_free)
+        download_cache.shrink(to_free)
+
+
+janitor = Janitor(JANITOR_INTERVAL)
+
+
+@app.before_request
+def start_background_tasks():
+    """Start per-process background threads on the first request"""
+    janitor.start()
+    recover_jobs()
+
+
+def get_ydl_opts(**overrides):
+    """Build yt-dlp options shared by extraction and download"""
+    ydl_opts = {
+        'quiet': True,
+        'no_warnings': True,
+        'extractor_args': {
+            'youtube': {
+                'player_client': list(PLAYER_CLIENTS),
+            }
+        },
+    }
+    
+    ydl_opts.update(overrides)
+    return ydl_opts
+
+
+def set_ydl_format(ydl, format_spec):
+    """Change the format a YoutubeDL handle selects (it compiles the selector up front)"""
+    ydl.params['format'] = format_spec
+    ydl.format_selector = ydl.build_format_selector(format_spec) if format_spec else None
+
+
+def cookie_files():
+    """COOKIES_FILE and every *.txt in COOKIES_DIR, each one cookie session"""
+    paths = [COOKIES_FILE] if COOKIES_FILE and os.path.exists(COOKIES_FILE) else []
+    if COOKIES_DIR and os.path.isdir(COOKIES_DIR):
+        paths += sorted(entry.path for entry in os.scandir(COOKIES_DIR)
+                        if entry.is_file() and entry.name.endswith('.txt'))
+    return paths
+
+
+class CookieSession:
+    """One account's cookies.txt: its cookie jar (parsed once) and its health"""
+
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.splitext(os.path.basename(path))[0]
+        self.jar = None  # parsed by the first handle created for the session
+        self.active = 0
+        self.last_used = 0.0
+        self.consecutive_failures = 0
+        self.cooldown_until = 0.0
+
+
+class CookiePool:
+    """Cookie sessions handed to jobs: least loaded first, then least recently used
+
+    A session that runs into a 429, a bot check or a sign-in wall cools down
+    for a backoff that doubles with each consecutive failure; a success resets
+    the count. Sessions in cooldown are only used when every other one is too
+    (the one that recovers first). Without cookie files the pool is empty and
+    jobs run without cookies.
+    """
+
+    def __init__(self, paths, cooldown, max_cooldown):
+        self.sessions = [CookieSession(path) for path in paths]
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self._lock = threading.Lock()
+
+    def _healthy(self, exclude, now):
+        return [session for session in self.sessions
+                if session not in exclude and session.cooldown_until <= now]
+
+    def available(self, exclude=()):
+        """Whether a session outside `exclude` is not cooling down"""
+        with self._lock:
+            return bool(self._healthy(exclude, time.time()))
+
+    def acquire(self, exclude=()):
+        if not self.sessions:
+            return None
+        with self._lock:
+            now = time.time()
+            candidates = self._healthy(exclude, now)
+            if candidates:
+                session = min(candidates, key=lambda s: (s.active, s.last_used))
+            else:
+                session = min(self.sessions, key=lambda s: (s.cooldown_until, s.active))
+            session.active += 1
+            session.last_used = now
+            return session
+
+    def release(self, session):
+        with self._lock:
+            session.active -= 1
+
+    def report(self, session, failure):
+        """Record a job's outcome: None for success, else its failure class"""
+        if failure is not None and failure not in SESSION_FAILURES:
+            return
+        with self._lock:
+            if failure is None:
+                session.consecutive_failures = 0
+                return
+            session.consecutive_failures += 1
+            backoff = min(self.cooldown * 2 ** (session.consecutive_failures - 1), self.max_cooldown)
+            session.cooldown_until = time.time() + backoff
+        cookie_session_failures_total.inc(session=session.name, failure=failure)
+        app.logger.warning('Cookie session %s hit %s, resting it for %d seconds', session.name, failure, backoff)
+
+    @contextlib.contextmanager
+    def checkout(self, exclude=()):
+        """Assign a session to a job for the duration of the block (None without sessions)"""
+        session = self.acquire(exclude)
+        if session is None:
+            yield None
+            return
+        try:
+            yield session
+        except Exception as e:
+            self.report(session, classify_failure(e))
+            raise
+        else:
+            self.report(session, None)
+        finally:
+            self.release(session)
+
+
+cookie_pool = CookiePool(cookie_files(), COOKIE_COOLDOWN, COOKIE_MAX_COOLDOWN)
+
+
+class YoutubeDLPool:
+    """Pre-configured YoutubeDL handles reused across requests
+
+    Building a YoutubeDL per request pays for extractor setup, cookie parsing
+    and fresh TLS connections. Pooled handles keep their extractor instances
+    and keep-alive HTTP sessions. Handles belong to one cookie session and
+    share its parsed cookie jar, so a session's cookies and connections stay
+    together. YoutubeDL is not thread-safe, so a handle serves one job at a
+    time; the per-job options are applied on checkout and undone on checkin.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._idle = {}  # cookie session -> handles, most recently used last (warmest connections)
+        self._lock = threading.Lock()
+
+    def _create(self, session):
+        opts = get_ydl_opts() if session is None else get_ydl_opts(cookiefile=session.path)
+        ydl = yt_dlp.YoutubeDL(opts, auto_init=EXTRACTORS == 'all')
+        if EXTRACTORS != 'all':
+            for ie in youtube_extractors():
+                ydl.add_info_extractor(ie)
+        if session is not None:
+            with self._lock:
+                if session.jar is None:
+                    session.jar = ydl.cookiejar  # parses the session's cookie file once
+                else:
+                    ydl.cookiejar = session.jar
+        return ydl
+
+    @contextlib.contextmanager
+    def handle(self, progress_hooks=(), session=None, **params):
+        """Check out a handle of a cookie session with per-job yt-dlp options applied"""
+        with self._lock:
+            idle = self._idle.get(session)
+            ydl = idle.pop() if idle else None
+        if ydl is None:
+            ydl = self._create(session)
+        
+        saved = {key: ydl.params[key] for key in params if key in ydl.params}
+        saved_outtmpl = ydl.params['outtmpl']
+        try:
+            ydl.params.update(params)
+            if 'outtmpl' in params:
+                ydl.params['outtmpl'] = {'default': params['outtmpl']}
+                ydl._parse_outtmpl()
+            if 'format' in params:
+                set_ydl_format(ydl, params['format'])
+            for hook in progress_hooks:
+                ydl.add_progress_hook(hook)
+            yield ydl
+        finally:
+            for key in params:
+                if key in saved:
+                    ydl.params[key] = saved[key]
+                else:
+                    ydl.params.pop(key, None)
+            ydl.params['outtmpl'] = saved_outtmpl
+            set_ydl_format(ydl, ydl.params.get('format'))
+            ydl._progress_hooks.clear()
+            ydl._download_retcode = 0
+            ydl._num_downloads = 0
+            with self._lock:
+                if sum(map(len, self._idle.values())) < self.size:
+                    self._idle.setdefault(session, []).append(ydl)
+                    ydl = None
+            if ydl is not None:
+                ydl.close()
+
+    def close(self):
+        """Close idle handles, saving cookies and releasing connections"""
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for handles in idle.values():
+            for ydl in handles:
+                ydl.close()
+
+
+def youtube_extractors():
+    """The extractor classes of yt-dlp's YouTube module, imported without the full extractor list
+
+    Their URL patterns exclude each other (watch pages go to YoutubeIE, lists
+    and channels to YoutubeTabIE), so definition order is a safe matching order.
+    """
+    from yt_dlp.extractor import youtube
+    return [ie for ie in vars(youtube).values()
+            if isinstance(ie, type) and issubclass(ie, yt_dlp.extractor.common.InfoExtractor)
+            and ie.__module__ == youtube.__name__ and ie.__name__.endswith('IE')]
+
+
+ydl_pool = YoutubeDLPool(YDL_POOL_SIZE)
+atexit.register(ydl_pool.close)
+
+
+def warm_up():
+    """Prepare a pooled YoutubeDL handle per cookie session before the first request
+
+    Builds the handle (extractor registry, cookie jar), imports and
+    instantiates the YouTube extractors with their format tables, sets up the
+    request handlers and compiles the default format selector. Nothing opens
+    a connection, so this is safe to run in a preloading master before fork.
+    """
+    for session in cookie_pool.sessions or [None]:
+        with ydl_pool.handle(session=session) as ydl:
+            for ie_key in list(ydl._ies):
+                if ie_key.startswith('Youtube'):
+                    ydl.get_info_extractor(ie_key).suitable('https://www.youtube.com/watch?v=dQw4w9WgXcQ')
+            ydl._request_director
+            ydl.build_format_selector('best[ext=mp4]/best')
+
+
+def canonical_video_id(url):
+    """Return the YouTube video ID for a URL, or the stripped URL if it has none"""
+    match = YOUTUBE_ID_RE.search(url)
+    return match.group(1) if match else url.strip()
+
+
+def get_cached_info(video_id):
+    """Return a cached info dict, or None if missing or expired"""
+    with metadata_cache_lock:
+        entry = metadata_cache.get(video_id)
+        if not entry:
+            return None
+        expires_at, info = entry
+        if expires_at < time.time():
+            del metadata_cache[video_id]
+            return None
+        metadata_cache.move_to_end(video_id)
+        return info
+
+
+def cache_info(video_id, info):
+    """Store an info dict in the metadata cache, evicting least recently used entries
+
+    Only what /api/info and downloads use is kept: no captions, thumbnail lists
+    or storyboard formats (image sprites with a URL per fragment).
+    """
+    if METADATA_CACHE_SIZE <= 0:
+        return
+    info = {key: value for key, value in info.items() if key not in UNCACHED_INFO_KEYS}
+    if info.get('formats'):
+        info['formats'] = [fmt for fmt in info['formats'] if fmt.get('ext') != 'mhtml']
+    with metadata_cache_lock:
+        metadata_cache[video_id] = (time.time() + METADATA_CACHE_TTL, info)
+        metadata_cache.move_to_end(video_id)
+        while len(metadata_cache) > METADATA_CACHE_SIZE:
+            metadata_cache.popitem(last=False)
+
+
+def invalidate_info(video_id):
+    """Drop a cached info dict"""
+    with metadata_cache_lock:
+        metadata_cache.pop(video_id, None)
+
+
+# Failure classes by message fragment, checked in order
+FAILURE_PATTERNS = (
+    ('rate_limited', ('HTTP Error 429', 'Too Many Requests')),
+    ('private', ('Private video', 'This video is private')),
+    ('geo_blocked', ('not available in your country', 'blocked it in your country')),
+    ('age_restricted', ('confirm your age', 'age-restricted', 'inappropriate for some users')),
+    ('bot_check', ("confirm you're not a bot", 'confirm you\u2019re not a bot')),
+    ('unavailable', ('Video unavailable', 'has been removed', 'This video is unavailable',
+                     'account associated with this video has been terminated')),
+    ('login_required', ('cookies are no longer valid', 'This video requires login', 'Sign in to')),
+)
+# Failures caused by the video itself rather than by the player client or network
+PERMANENT_FAILURES = ('private', 'geo_blocked', 'age_restricted', 'unavailable')
+# Failures that count against the cookie session that was used
+SESSION_FAILURES = ('rate_limited', 'bot_check', 'login_required')
 
-def update_progress(download_id, progress, status='downloading', filepath=None, error_msg=None):
-    """Update download progress"""
-    with progress_lock:
-        download_progress[download_id] = {
-            'progress': progress,
-            'status': status,
-            'timestamp': time.time()
-        }
-        if error_msg:
-            download_progress[download_id]['error'] = error_msg
-        if filepath:
-            download_files[download_id] = filepath
+
+class ExtractionFailed(Exception):
+    """Raised instead of extracting a video whose extraction failed recently"""
+
+    def __init__(self, message, failure):
+        super().__init__(message)
+        self.failure = failure
+
+
+class UpstreamBusy(Exception):
+    """Raised while the upstream circuit breaker is open after HTTP 429s"""
+
+    def __init__(self, retry_after):
+        super().__init__(f'YouTube is rate limiting this server, please retry in {retry_after} seconds')
+        self.retry_after = retry_after
+
+
+def classify_failure(exc):
+    """Failure class of an extraction or download error (see FAILURE_PATTERNS)"""
+    cause = exc.exc_info[1] if isinstance(exc, yt_dlp.utils.DownloadError) and exc.exc_info else exc
+    if isinstance(cause, yt_dlp.utils.GeoRestrictedError):
+        return 'geo_blocked'
+    if getattr(getattr(cause, 'response', None), 'status', None) == 429:
+        return 'rate_limited'
+    message = str(exc)
+    for failure, fragments in FAILURE_PATTERNS:
+        if any(fragment in message for fragment in fragments):
+            return failure
+    return 'other'
+
+
+def remember_failure(video_id, failure, message):
+    """Negative-cache a failed extraction for its failure class's TTL"""
+    ttl = NEGATIVE_CACHE_TTL if failure in PERMANENT_FAILURES else NEGATIVE_CACHE_TTL_TRANSIENT
+    if ttl <= 0 or METADATA_CACHE_SIZE <= 0:
+        return
+    with metadata_cache_lock:
+        negative_cache[video_id] = (time.time() + ttl, failure, message)
+        negative_cache.move_to_end(video_id)
+        while len(negative_cache) > METADATA_CACHE_SIZE:
+            negative_cache.popitem(last=False)
+    if JOB_RUNNER == 'worker':
+        # Workers extract, but the front-end answers retries
+        journal.remember_failure(video_id, time.time() + ttl, failure, message)
+
+
+def check_failure_cache(video_id):
+    """Raise ExtractionFailed if the video's last extraction failed within its TTL"""
+    with metadata_cache_lock:
+        entry = negative_cache.get(video_id)
+        if entry and entry[0] < time.time():
+            del negative_cache[video_id]
+            entry = None
+    if entry is None and JOB_RUNNER == 'worker':
+        entry = journal.failure(video_id)
+    cache_lookups_total.inc(cache='negative', result='hit' if entry else 'miss')
+    if entry:
+        raise ExtractionFailed(entry[2], entry[1])
+
+
+class PlayerClientRanking:
+    """Orders YouTube player clients by a moving average of their success"""
+
+    def __init__(self, clients, weight=0.1):
+        self.clients = list(clients)
+        self.weight = weight
+        self.scores = {client: 0.5 for client in self.clients}
+        self._lock = threading.Lock()
+
+    def order(self):
+        with self._lock:
+            # sorted() is stable, so ties keep the configured order
+            return sorted(self.clients, key=lambda client: -self.scores[client])
+
+    def record(self, client, success):
+        with self._lock:
+            self.scores[client] += self.weight * (float(success) - self.scores[client])
+
+
+class CircuitBreaker:
+    """Stops upstream requests for a growing backoff after HTTP 429s
+
+    With a shared journal, a breaker tripped in one process opens in all of them.
+    """
+
+    def __init__(self, backoff, max_backoff, shared=None):
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.shared = shared
+        self._current = 0
+        self._open_until = 0
+        self._lock = threading.Lock()
+
+    def retry_after(self):
+        """Seconds until upstream may be tried again, 0 if the breaker is closed"""
+        open_until = self._open_until
+        if self.shared is not None:
+            open_until = max(open_until, self.shared.upstream_paused_until())
+        remaining = open_until - time.time()
+        return int(remaining) + 1 if remaining > 0 else 0
+
+    def check(self):
+        retry_after = self.retry_after()
+        if retry_after:
+            raise UpstreamBusy(retry_after)
+
+    def trip(self):
+        with self._lock:
+            self._current = min(max(self._current * 2, self.backoff), self.max_backoff)
+            self._open_until = time.time() + self._current
+        if self.shared is not None:
+            self.shared.pause_upstream(self._open_until)
+        app.logger.warning('Upstream returned 429, pausing extraction for %d seconds', self._current)
+
+    def reset(self):
+        with self._lock:
+            self._current = 0
+
+
+player_clients = PlayerClientRanking(PLAYER_CLIENTS)
+upstream_breaker = CircuitBreaker(UPSTREAM_BACKOFF, UPSTREAM_MAX_BACKOFF,
+                                  shared=journal if JOB_RUNNER == 'worker' else None)
+
+
+def run_extraction(url, video_id):
+    """Extract a video, one player client at a time, best client first
+
+    A failure caused by the video itself ends the attempts and is negative-
+    cached; other failures move on to the next client. A 429, bot check or
+    sign-in wall on a cookie session first retries on another healthy
+    session. A 429 with none left opens the circuit breaker.
+    """
+    clients = deque(player_clients.order() if YOUTUBE_ID_RE.search(url) else [None])
+    tried_sessions = []
+    while True:
+        client = clients[0]
+        params = {} if client is None else {'extractor_args': {'youtube': {'player_client': [client]}}}
+        try:
+            with cookie_pool.checkout(exclude=tried_sessions) as session, \
+                    ydl_pool.handle(session=session, **params) as ydl, extraction_seconds.time():
+                info = ydl.extract_info(url, download=False)
+        except yt_dlp.utils.DownloadError as e:
+            failure = classify_failure(e)
+            if session is not None and failure in SESSION_FAILURES:
+                tried_sessions.append(session)
+                if cookie_pool.available(exclude=tried_sessions):
+                    continue
+            if failure == 'rate_limited':
+                upstream_breaker.trip()
+                raise UpstreamBusy(upstream_breaker.retry_after()) from e
+            if client is not None and failure not in PERMANENT_FAILURES:
+                player_clients.record(client, False)
+            clients.popleft()
+            if failure in PERMANENT_FAILURES or not clients:
+                remember_failure(video_id, failure, str(e))
+                raise
+            continue
+        if client is not None:
+            player_clients.record(client, True)
+        upstream_breaker.reset()
+        return info
+
+
+def extract_video_info(url):
+    """Extract video metadata, reusing a cached extraction (or failure) when available"""
+    video_id = canonical_video_id(url)
+    info = get_cached_info(video_id)
+    cache_lookups_total.inc(cache='metadata', result='miss' if info is None else 'hit')
+    if info is None:
+        check_failure_cache(video_id)
+        upstream_breaker.check()
+        info = run_extraction(url, video_id)
+        cache_info(video_id, info)
+    return info
 
 
 def get_video_info(url):
     """Get video information without downloading using yt-dlp"""
     try:
-        ydl_opts = {
-            'quiet': True,
-            'no_warnings': True,
-            'extract_flat': False,
-            'extractor_args': {
-                'youtube': {
-                    'player_client': ['ios', 'android', 'web'],
-                }
-            },
+        info = extract_video_info(url)
+        
+        video_info = {
+            'title': info.get('title', 'Unknown'),
+            'author': info.get('uploader', 'Unknown'),
+            'length': info.get('duration', 0),
+            'views': info.get('view_count', 0),
+            'thumbnail': info.get('thumbnail', ''),
+            'chapters': [{'title': chapter.get('title'), 'start_time': chapter.get('start_time'),
+                          'end_time': chapter.get('end_time')} for chapter in info.get('chapters') or []],
+            'available_streams': []
         }
         
-        # Add cookies if available
-        if COOKIES_FILE and os.path.exists(COOKIES_FILE):
-            ydl_opts['cookiefile'] = COOKIES_FILE
+        # Get available formats; video-only ones need merge (and ffmpeg) to get sound
+        formats = info.get('formats', [])
+        for fmt in formats:
+            if fmt.get('vcodec') != 'none':
+                video_info['available_streams'].append({
+                    'format_id': fmt.get('format_id'),
+                    'resolution': fmt.get('resolution', 'unknown'),
+                    'height': fmt.get('height'),
+                    'fps': fmt.get('fps'),
+                    'ext': fmt.get('ext'),
+                    'vcodec': fmt.get('vcodec'),
+                    'has_audio': fmt.get('acodec') != 'none',
+                    'filesize': format_size(fmt, info.get('duration')),
+                    'format_note': fmt.get('format_note', '')
+                })
+        video_info['merge_available'] = FFMPEG_AVAILABLE
         
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=False)
-            
-            video_info = {
-                'title': info.get('title', 'Unknown'),
-                'author': info.get('uploader', 'Unknown'),
-                'length': info.get('duration', 0),
-                'views': info.get('view_count', 0),
-                'thumbnail': info.get('thumbnail', ''),
-                'available_streams': []
-            }
-            
-            # Get available formats
-            formats = info.get('formats', [])
-            for fmt in formats:
-                if fmt.get('vcodec') != 'none' and fmt.get('ext') == 'mp4':
-                    video_info['available_streams'].append({
-                        'format_id': fmt.get('format_id'),
-                        'resolution': fmt.get('resolution', 'unknown'),
-                        'fps': fmt.get('fps'),
-                        'filesize': fmt.get('filesize'),
-                        'format_note': fmt.get('format_note', '')
-                    })
-            
-            return video_info, None
+        return video_info, None
+    except UpstreamBusy:
+        raise
     except Exception as e:
+        errors_total.inc(stage='info', error=error_class(e))
         return None, str(e)
 
 
-def progress_hook(d, download_id):
-    """Progress hook for yt-dlp"""
+def parse_format_request(data):
+    """Read the format choice of a download request; raise ValueError if invalid
+
+    `quality` presets map onto max_height; `format_id`, `max_height`, `vcodec`
+    (codec prefix such as avc1, vp9 or av01), `max_filesize` (bytes) and
+    `merge` refine or replace them. `mode` is video or audio, and `remux` a
+    container from REMUX_FORMATS for that mode. `start`/`end` or `chapters`
+    request a clip (see parse_clip).
+    """
+    quality = data.get('quality', 'highest')
+    mode = data.get('mode', 'video')
+    if mode not in REMUX_FORMATS:
+        raise ValueError('mode must be video or audio')
+    remux = data.get('remux') or None
+    if remux is not None and remux not in REMUX_FORMATS[mode]:
+        raise ValueError(f"remux must be one of {', '.join(REMUX_FORMATS[mode])} in {mode} mode")
+    format_request = {
+        'mode': mode,
+        'remux': remux,
+        'format_id': data.get('format_id') or None,
+        'max_height': data.get('max_height') or QUALITY_HEIGHTS.get(quality),
+        'vcodec': data.get('vcodec') or None,
+        'max_filesize': data.get('max_filesize') or None,
+        'lowest': quality == 'lowest',
+        'merge': mode == 'video' and bool(data.get('merge', MERGE_FORMATS)),
+        'clip': parse_clip(data),
+    }
+    for key in ('max_height', 'max_filesize'):
+        if format_request[key] is not None:
+            try:
+                format_request[key] = int(format_request[key])
+            except (TypeError, ValueError):
+                raise ValueError(f'{key} must be an integer')
+    if format_request['format_id'] and '+' in format_request['format_id']:
+        format_request['merge'] = True
+    if format_request['merge'] and not FFMPEG_AVAILABLE:
+        if 'merge' in data or format_request['format_id']:
+            raise ValueError('Merging formats requires ffmpeg, which is not installed')
+        format_request['merge'] = False
+    return format_request
+
+
+def parse_clip(data):
+    """Read a clip request: `start`/`end` (seconds or [HH:]MM:SS) or `chapters` titles
+
+    Returns None for a whole-video download; raises ValueError if invalid.
+    """
+    chapters = data.get('chapters') or []
+    if isinstance(chapters, str):
+        chapters = [chapters]
+    bounds = {}
+    for key in ('start', 'end'):
+        value = data.get(key)
+        if value is None or value == '':
+            continue
+        seconds = value if isinstance(value, (int, float)) else yt_dlp.utils.parse_duration(str(value))
+        if seconds is None or seconds < 0:
+            raise ValueError(f'{key} must be a time in seconds or [HH:]MM:SS')
+        bounds[key] = float(seconds)
+    if not chapters and not bounds:
+        return None
+    if chapters and bounds:
+        raise ValueError('Request either chapters or start/end, not both')
+    if not all(isinstance(title, str) and title for title in chapters):
+        raise ValueError('chapters must be chapter titles')
+    if 'start' in bounds and 'end' in bounds and bounds['end'] <= bounds['start']:
+        raise ValueError('end must be after start')
+    if not FFMPEG_AVAILABLE:
+        raise ValueError('Clips require ffmpeg, which is not installed')
+    return {'start': bounds.get('start'), 'end': bounds.get('end'), 'chapters': chapters}
+
+
+def clip_section(info, clip):
+    """(start, end) seconds of a clip; several chapters span from the first to the last"""
+    duration = info.get('duration')
+    if clip['chapters']:
+        by_title = {(chapter.get('title') or '').casefold(): chapter for chapter in info.get('chapters') or []}
+        missing = [title for title in clip['chapters'] if title.casefold() not in by_title]
+        if missing:
+            available = ', '.join(chapter.get('title') or '?' for chapter in info.get('chapters') or [])
+            raise ValueError(f"Chapter {missing[0]!r} not found (chapters: {available or 'none'})")
+        chosen = [by_title[title.casefold()] for title in clip['chapters']]
+        start = min(chapter['start_time'] for chapter in chosen)
+        end = max(chapter['end_time'] for chapter in chosen)
+    else:
+        start, end = clip['start'] or 0, clip['end']
+    if duration:
+        end = min(end or duration, duration)
+    if end is not None and end <= start:
+        raise ValueError('The clip starts after the end of the video')
+    return start, end
+
+
+def clip_report(section, selected, duration, filepath):
+    """Clip fields of a finished job, with the bytes saved against the whole format"""
+    formats = selected.get('requested_formats') or [selected]
+    sizes = [format_size(fmt, duration) for fmt in formats]
+    full_bytes = sum(sizes) if all(sizes) else None
+    clip_bytes = os.path.getsize(filepath)
+    return {
+        'start': section[0],
+        'end': section[1],
+        'bytes': clip_bytes,
+        'full_bytes': full_bytes,
+        'bytes_saved': max(0, full_bytes - clip_bytes) if full_bytes else None,
+    }
+
+
+def format_size(fmt, duration):
+    """Known or estimated size of a format in bytes, or None"""
+    size = fmt.get('filesize') or fmt.get('filesize_approx')
+    if not size and fmt.get('tbr') and duration:
+        size = int(fmt['tbr'] * 125 * duration)  # kbit/s over the whole video
+    return size
+
+
+def audio_rank(fmt, fits=True, lowest=False):
+    """Sort key for audio formats: original language, yt-dlp's preference, then
+    the container or codec fit, bitrate and quality (the lowest bitrate if `lowest`)
+
+    Dubbed, descriptive and DRC tracks often share the original's bitrate.
+    """
+    def field(name):
+        value = fmt.get(name)
+        return -1 if value is None else value
+    bitrate = fmt.get('abr') or fmt.get('tbr') or 0
+    if lowest:
+        return (field('language_preference'), field('preference'), fits, -bitrate, field('quality'))
+    return (field('language_preference'), field('preference'), fits, field('quality'), bitrate)
+
+
+def select_format(info, format_request):
+    """Resolve a format request against an info dict's formats into a yt-dlp format spec
+
+    Picks the tallest progressive format within the budget, or with merge
+    enabled a video-only format plus the best matching audio when that is
+    taller. Height falls back to the shortest format if none fits; codec and
+    size limits are strict.
+    """
+    formats = info.get('formats') or []
+    by_id = {fmt.get('format_id'): fmt for fmt in formats}
+    if format_request['format_id']:
+        missing = [part for part in format_request['format_id'].split('+') if part not in by_id]
+        if missing:
+            raise ValueError(f"Format {', '.join(missing)} is not available for this video")
+        return format_request['format_id']
+    
+    duration = info.get('duration')
+    audio = [fmt for fmt in formats if fmt.get('vcodec') == 'none' and fmt.get('acodec') not in (None, 'none')]
+    if format_request['mode'] == 'audio':
+        return select_audio_format(audio, format_request, duration)
+    candidates = []
+    for fmt in formats:
+        # Unknown codecs (None) are assumed present, as yt-dlp does
+        if fmt.get('vcodec') == 'none':
+            continue
+        if format_request['vcodec'] and not (fmt.get('vcodec') or '').startswith(format_request['vcodec']):
+            continue
+        if fmt.get('acodec') != 'none':
+            candidates.append(([fmt], format_size(fmt, duration)))
+        elif format_request['merge'] and audio:
+            # Prefer audio in a container that merges without falling back to mkv
+            audio_ext = 'm4a' if fmt.get('ext') == 'mp4' else fmt.get('ext')
+            # yt-dlp lists formats worst first, so ties go to the one it prefers
+            best_audio = max(reversed(audio), key=lambda a: audio_rank(a, a.get('ext') == audio_ext))
+            video_size, audio_size = format_size(fmt, duration), format_size(best_audio, duration)
+            candidates.append(([fmt, best_audio], video_size and audio_size and video_size + audio_size))
+    
+    if format_request['max_filesize']:
+        candidates = [(parts, size) for parts, size in candidates
+                      if size is not None and size <= format_request['max_filesize']]
+    if not candidates:
+        raise ValueError('No format matches the requested codec and size')
+    
+    max_height = format_request['max_height']
+    fitting = [c for c in candidates if max_height is None or (c[0][0].get('height') or 0) <= max_height]
+    
+    def rank(candidate):
+        video = candidate[0][0]
+        # Taller first, then a single file (streamable, no merge), then mp4 for compatibility
+        return (video.get('height') or 0, len(candidate[0]) == 1, video.get('ext') == 'mp4',
+                video.get('fps') or 0, video.get('tbr') or 0)
+    
+    if format_request['lowest'] or not fitting:
+        # Shortest (then smallest) format when asked for, or when none is short enough
+        parts, _ = min(fitting or candidates, key=lambda c: (c[0][0].get('height') or 0, c[1] or float('inf')))
+    else:
+        parts, _ = max(fitting, key=rank)
+    return '+'.join(fmt['format_id'] for fmt in parts)
+
+
+def select_audio_format(audio, format_request, duration):
+    """Best audio-only format within the size budget, preferring codecs the remux target takes"""
+    if format_request['max_filesize']:
+        audio = [fmt for fmt in audio
+                 if (format_size(fmt, duration) or float('inf')) <= format_request['max_filesize']]
+    if not audio:
+        raise ValueError('No audio-only format matches the request')
+    codecs = REMUX_FORMATS['audio'][format_request['remux']][2] if format_request['remux'] else None
+    
+    def rank(fmt):
+        fits = codecs is None or (fmt.get('acodec') or '').startswith(codecs)
+        return audio_rank(fmt, fits, format_request['lowest'])
+    
+    # yt-dlp lists formats worst first, so ties go to the one it prefers
+    return max(reversed(audio), key=rank)['format_id']
+
+
+def remux_target(format_request, selected):
+    """Container the finished file must be remuxed to when served, or None
+
+    Raises ValueError if the selected format's codec does not fit that
+    container: ffmpeg would only fail after the response has started.
+    """
+    remux, ext = format_request['remux'], selected['ext']
+    if not remux or remux == ext:
+        return None
+    if not FFMPEG_AVAILABLE:
+        raise ValueError(f'Remuxing {ext} to {remux} requires ffmpeg, which is not installed')
+    codecs = REMUX_FORMATS[format_request['mode']][remux][2]
+    codec = selected.get('acodec') or ''
+    if codecs and not codec.startswith(codecs):
+        raise ValueError(f"{remux} cannot hold {codec or 'unknown'} audio (format {selected['format_id']}); "
+                         f"choose a format with {'/'.join(codecs)} audio or another remux container")
+    return remux
+
+
+def container_mimetype(ext, audio_only=False):
+    """MIME type of a container by its extension"""
+    mimetype = CONTAINER_MIMETYPES.get(ext, 'application/octet-stream')
+    if audio_only and mimetype.startswith('video/'):
+        mimetype = 'audio/' + mimetype.split('/', 1)[1]
+    return mimetype
+
+
+def remux_pipe(filepath, target, mode):
+    """Yield a file remuxed to another container by ffmpeg (stream copy), without touching disk"""
+    muxer, args, _ = REMUX_FORMATS[mode][target]
+    process = subprocess.Popen(
+        ['ffmpeg', '-nostdin', '-loglevel', 'error', '-i', filepath,
+         '-map', '0', '-c', 'copy', *args, '-f', muxer, 'pipe:1'],
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    try:
+        while True:
+            chunk = process.stdout.read(STREAM_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+        if process.wait() != 0:
+            # Abort the connection so the client sees an incomplete transfer
+            raise IOError(f'ffmpeg failed to remux {filepath} to {target}')
+    finally:
+        if process.poll() is None:
+            process.kill()
+        process.stdout.close()
+        process.wait()
+
+
+def progress_hook(d, download_id, state):
+    """Progress hook for yt-dlp
+
+    `state` is per-job: the time and progress of the last published update
+    (chunks in between are dropped), the bytes of the current file already
+    counted in the metrics, and `extra` fields added to every update.
+    """
+    downloaded = d.get('downloaded_bytes') or 0
+    if d.get('filename') != state.get('counted_file'):
+        state['counted_file'] = d.get('filename')
+        state['counted'] = 0
+    if downloaded > state['counted']:
+        downloaded_bytes_total.inc(downloaded - state['counted'])
+        if state.get('flow'):
+            # Blocking here holds the download (or fragment) thread to the job's share
+            state['flow'].consume(downloaded - state['counted'])
+        state['counted'] = downloaded
+    
     if d['status'] == 'downloading':
-        if 'total_bytes' in d:
-            progress = (d['downloaded_bytes'] / d['total_bytes']) * 100
-        elif 'total_bytes_estimate' in d:
-            progress = (d['downloaded_bytes'] / d['total_bytes_estimate']) * 100
+        total_bytes = d.get('total_bytes') or d.get('total_bytes_estimate')
+        if total_bytes:
+            progress = (d['downloaded_bytes'] / total_bytes) * 100
         else:
             progress = 0
-        update_progress(download_id, progress, 'downloading')
+        
+        now = time.monotonic()
+        if (now - state['time'] < PROGRESS_UPDATE_INTERVAL
+                and abs(progress - state['progress']) < PROGRESS_UPDATE_DELTA):
+            return
+        state['time'] = now
+        state['progress'] = progress
+        
+        stats = {
+            'downloaded_bytes': d.get('downloaded_bytes'),
+            'total_bytes': total_bytes,
+            'speed': d.get('speed'),
+            'eta': d.get('eta'),
+            'partial_path': d.get('tmpfilename'),
+        }
+        stats.update(ingress_budget.job_rates(download_id))
+        stats.update(state['extra'])
+        update_progress(download_id, progress, 'downloading', stats=stats)
     elif d['status'] == 'finished':
         # Don't mark as completed here - let download_video handle it
-        update_progress(download_id, 95, 'processing')
+        update_progress(download_id, 95, 'processing', stats=state['extra'])
+
+
+def job_dir(download_id):
+    """Directory a job downloads into"""
+    return os.path.join(JOBS_DIR, download_id)
+
 
+def downloaded_filepath(result):
+    """Final file path of a download, from yt-dlp's post-processing info"""
+    downloads = result.get('requested_downloads') or [{}]
+    return downloads[0].get('filepath') or downloads[0].get('filename')
 
-def download_video(url, download_id, quality='highest'):
+
+def download_video(url, download_id, format_request=None, concurrent_fragments=CONCURRENT_FRAGMENTS,
+                   client=None):
     """Download YouTube video with progress tracking using yt-dlp"""
-    downloaded_filepath = None
+    following = False
     try:
+        journal.set_state(download_id, 'running')
         update_progress(download_id, 0, 'initializing')
-        
-        # Map quality to yt-dlp format selector (using single-file formats to avoid ffmpeg requirement)
-        format_selector = 'best[ext=mp4]/best'
-        if quality == '720p':
-            format_selector = 'best[height<=720][ext=mp4]/best[height<=720]/best'
-        elif quality == '480p':
-            format_selector = 'best[height<=480][ext=mp4]/best[height<=480]/best'
-        elif quality == '360p':
-            format_selector = 'best[height<=360][ext=mp4]/best[height<=360]/best'
-        elif quality == '240p':
-            format_selector = 'best[height<=240][ext=mp4]/best[height<=240]/best'
-        elif quality == '144p':
-            format_selector = 'best[height<=144][ext=mp4]/best[height<=144]/best'
-        elif quality == 'lowest':
-            format_selector = 'worst[ext=mp4]/worst'
+        if format_request is None:
+            format_request = parse_format_request({})
         
         update_progress(download_id, 5, 'fetching_info')
         
-        # Store downloaded filepath in hook
-        downloaded_filepath_container = {'path': None}
-        
         # Create progress hook
-        def hook(d):
-            progress_hook(d, download_id)
-            if d['status'] == 'finished' and 'filename' in d:
-                downloaded_filepath_container['path'] = d['filename']
+        state = {'time': 0, 'progress': 0, 'counted': 0, 'extra': {}}
         
-        # Get info first to get filename
-        ydl_opts_info = {
-            'quiet': True,
-            'no_warnings': True,
-            'extractor_args': {
-                'youtube': {
-                    'player_client': ['ios', 'android', 'web'],
-                }
-            },
-        }
+        def hook(d):
+            progress_hook(d, download_id, state)
         
-        # Add cookies if available
-        if COOKIES_FILE and os.path.exists(COOKIES_FILE):
-            ydl_opts_info['cookiefile'] = COOKIES_FILE
+        # Reuse the extraction from /api/info when it is still cached
+        video_id = canonical_video_id(url)
+        cached = get_cached_info(video_id) is not None
+        info = extract_video_info(url)
+        title = info.get('title', 'video')
         
-        with yt_dlp.YoutubeDL(ydl_opts_info) as ydl:
-            info = ydl.extract_info(url, download=False)
-            title = info.get('title', 'video')
+        # Choose from the already extracted format list instead of a fixed selector string
+        format_selector = select_format(info, format_request)
         
         # Clean filename
         safe_title = secure_filename(title)
         
-        # Configure yt-dlp options for download
-        ydl_opts = {
-            'format': format_selector,
-            'outtmpl': os.path.join(DOWNLOAD_DIR, safe_title + '.%(ext)s'),
-            'progress_hooks': [hook],
-            'quiet': False,
-            'no_warnings': False,
-            'extractor_args': {
-                'youtube': {
-                    'player_client': ['ios', 'android', 'web'],
-                }
-            },
-        }
-        
-        # Add cookies if available
-        if COOKIES_FILE and os.path.exists(COOKIES_FILE):
-            ydl_opts['cookiefile'] = COOKIES_FILE
-        
-        update_progress(download_id, 10, 'downloading')
-        
-        # Download
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            ydl.download([url])
+        # A clip is cut by ffmpeg with stream copy (at keyframes), which reads
+        # only the byte ranges of that section
+        section = clip_section(info, format_request['clip']) if format_request.get('clip') else None
+        clip_params = {}
+        if section:
+            clip_params['download_ranges'] = yt_dlp.utils.download_range_func(None, [section])
+            safe_title = f'{safe_title}-clip-{section[0]:g}-{section[1]:g}' if section[1] else \
+                f'{safe_title}-clip-{section[0]:g}'
         
-        # Get the downloaded file path
-        filepath = downloaded_filepath_container['path']
-        
-        # If hook didn't provide path, try to find it
-        if not filepath or not os.path.exists(filepath):
-            # Try the expected path first
-            for ext in ['.mp4', '.webm', '.mkv', '.m4a']:
-                test_path = os.path.join(DOWNLOAD_DIR, safe_title + ext)
-                if os.path.exists(test_path):
-                    filepath = test_path
-                    break
+        # Configure yt-dlp options for download; the job's own directory keeps
+        # concurrent jobs from ever sharing a file name
+        with cookie_pool.checkout() as session, ydl_pool.handle(
+            session=session,
+            format=format_selector,
+            outtmpl=os.path.join(job_dir(download_id), '%(id)s.%(format_id)s.%(ext)s'),
+            progress_hooks=[hook],
+            concurrent_fragment_downloads=concurrent_fragments,
+            ratelimit=None,
+            quiet=False,
+            no_warnings=False,
+            **clip_params,
+        ) as ydl:
+            # Resolve the format first so identical requests share one cache entry.
+            # process_ie_result mutates its input, so hand it sanitized copies.
+            selected = ydl.process_ie_result(ydl.sanitize_info(info, remove_private_keys=True), download=False)
+            cache_key = (selected['id'], selected['format_id'])
+            if section:
+                cache_key += (f'{section[0]:g}-{section[1] or ""}',)
+            # The cache holds the downloaded container; a remux happens when the file is served
+            remux = remux_target(format_request, selected)
+            outputs = {
+                'title': title,
+                'download_name': f"{safe_title}.{remux or selected['ext']}",
+                'mode': format_request['mode'],
+                'remux': remux,
+            }
+            job_outputs[download_id] = outputs
             
-            # If still not found, search by prefix
-            if not filepath or not os.path.exists(filepath):
-                base_name = safe_title
-                for file in os.listdir(DOWNLOAD_DIR):
-                    if file.startswith(base_name) and file.endswith(('.mp4', '.webm', '.mkv')):
-                        filepath = os.path.join(DOWNLOAD_DIR, file)
-                        break
+            if section:
+                outputs['clip'] = {'start': section[0], 'end': section[1]}
+            
+            role, result = download_cache.claim(cache_key, selected['ext'], download_id)
+            if role == 'hit':
+                if section:
+                    outputs['clip'] = clip_report(section, selected, info.get('duration'), result)
+                update_progress(download_id, 100, 'completed', result, stats=outputs)
+                return result, None
+            if role == 'follower':
+                # The in-flight job now publishes progress for this download too
+                following = True
+                return None, None
+            
+            # The job's ingress share, also applied as yt-dlp's own rate limit
+            state['flow'] = ingress_budget.join(
+                download_id, client, on_change=lambda rate: ydl.params.update(ratelimit=rate))
+            try:
+                # A single file fetched over plain HTTP(S) is written to one growing
+                # .part file, already in its container, that /api/download/<id>/stream
+                # can tail. Merged, remuxed and clipped ones are not, and HLS/DASH
+                # downloads (MPEG-TS or fragments) are only fixed up afterwards.
+                state['extra'] = dict(outputs, streamable=selected.get('protocol') in ('http', 'https')
+                                      and not selected.get('requested_formats') and not remux and not section)
+                update_progress(download_id, 10, 'downloading', stats=state['extra'])
+                
+                # Download straight from the info dict instead of extracting again
+                set_ydl_format(ydl, selected['format_id'])
+                try:
+                    result = ydl.process_ie_result(ydl.sanitize_info(info, remove_private_keys=True), download=True)
+                except yt_dlp.utils.DownloadError:
+                    if not cached:
+                        raise
+                    # Cached stream URLs may have expired; retry once with a fresh extraction
+                    invalidate_info(video_id)
+                    errors_total.inc(stage='download_retry', error='DownloadError')
+                    result = ydl.extract_info(url, download=True)
+                    cache_info(video_id, ydl.sanitize_info(result, remove_private_keys=True))
+                
+                # The final path (after merging and post-processing) is in the result
+                filepath = downloaded_filepath(result)
+                if filepath and os.path.exists(filepath):
+                    filepath = download_cache.store(cache_key, selected['ext'], filepath)
+            finally:
+                if state['flow']:
+                    ingress_budget.leave(state['flow'])
+                # From here on new requests hit the cache (or retry after an error)
+                download_cache.release(cache_key)
         
         if filepath and os.path.exists(filepath):
-            update_progress(download_id, 100, 'completed', filepath)
+            if section:
+                outputs['clip'] = clip_report(section, selected, info.get('duration'), filepath)
+                clip_bytes_saved_total.inc(outputs['clip']['bytes_saved'] or 0)
+            update_progress(download_id, 100, 'completed', filepath, stats=outputs)
             return filepath, None
         else:
-            error_msg = f"Downloaded file not found. Searched in {DOWNLOAD_DIR}"
+            error_msg = "Downloaded file not found"
             update_progress(download_id, 0, 'error', error_msg=error_msg)
             return None, error_msg
                 
     except Exception as e:
+        errors_total.inc(stage='download', error=error_class(e))
+        if classify_failure(e) == 'rate_limited':
+            upstream_breaker.trip()
         error_msg = str(e)
         update_progress(download_id, 0, 'error', error_msg=error_msg)
         return None, error_msg
+    finally:
+        followers = job_followers.pop(download_id, ())
+        for follower in followers:
+            job_outputs.pop(follower, None)
+        if not following:
+            job_outputs.pop(download_id, None)
+            # A follower's outcome is journaled when the job it follows ends
+            for finished_id in (download_id, *followers):
+                record = progress_store.get(finished_id)
+                if record:
+                    journal.set_state(finished_id, record['status'], record)
+        shutil.rmtree(job_dir(download_id), ignore_errors=True)
+
+
+def expand_urls(urls):
+    """Expand playlist and channel URLs into (url, title) items using flat extraction
+
+    YouTube video URLs are passed through untouched (title None): their
+    download jobs extract them through run_extraction like any other.
+    """
+    items = []
+    with contextlib.ExitStack() as stack:
+        ydl = None
+        for url in urls:
+            if YOUTUBE_ID_RE.search(url) and 'list=' not in url:
+                items.append((url, None))
+            else:
+                if ydl is None:
+                    session = stack.enter_context(cookie_pool.checkout())
+                    ydl = stack.enter_context(ydl_pool.handle(session=session, extract_flat='in_playlist'))
+                info = ydl.extract_info(url, download=False)
+                if info.get('_type') == 'playlist':
+                    for entry in info.get('entries') or []:
+                        if entry and (entry.get('url') or entry.get('webpage_url')):
+                            items.append((entry.get('webpage_url') or entry['url'], entry.get('title')))
+                else:
+                    # A video of another site was fully extracted; let its download reuse that
+                    cache_info(canonical_video_id(url), ydl.sanitize_info(info, remove_private_keys=True))
+                    items.append((url, info.get('title')))
+            if len(items) >= BATCH_MAX_ITEMS:
+                return items[:BATCH_MAX_ITEMS]
+    return items
+
+
+def parse_concurrent_fragments(data):
+    """Read the requested fragment parallelism, bounded by MAX_CONCURRENT_FRAGMENTS"""
+    try:
+        value = int(data.get('concurrent_fragments', CONCURRENT_FRAGMENTS))
+    except (TypeError, ValueError):
+        value = CONCURRENT_FRAGMENTS
+    return max(1, min(value, MAX_CONCURRENT_FRAGMENTS))
+
+
+def start_batch(items, format_request, parallelism, concurrent_fragments, client):
+    """Schedule batch items so that at most `parallelism` are queued or running at once"""
+    pending = deque(items)
+    pending_lock = threading.Lock()
+    
+    def submit_next():
+        with pending_lock:
+            if not pending:
+                return
+            download_id, url = pending.popleft()
+        
+        def batch_item_job():
+            try:
+                download_video(url, download_id, format_request, concurrent_fragments=concurrent_fragments,
+                               client=client)
+            finally:
+                submit_next()
+        
+        scheduler.submit(download_id, batch_item_job, client=client, priority=BATCH_PRIORITY,
+                         enforce_limits=False)
+    
+    for download_id, url in items:
+        update_progress(download_id, 0, 'queued')
+    for _ in range(parallelism):
+        submit_next()
+
+
+def fail_orphaned_items(download_ids):
+    """Fail batch items whose batch is no longer in the journal, instead of retrying them"""
+    for download_id in download_ids:
+        update_progress(download_id, 0, 'error', error_msg='The batch of this download no longer exists')
+        journal.set_state(download_id, 'error', progress_store.get(download_id))
+
+
+def admit_jobs(client, jobs=1):
+    """Raise QueueFull unless `jobs` more jobs from `client` fit wherever downloads run"""
+    if JOB_RUNNER == 'worker':
+        journal.admit(client, jobs)
+    else:
+        scheduler.admit(client, jobs)
+
+
+def submit_download(download_id, job):
+    """Journal a single download and queue it wherever downloads run"""
+    admit_jobs(job['client'])
+    if JOB_RUNNER == 'worker':
+        # A worker process may pick the job up as soon as it is journaled
+        update_progress(download_id, 0, 'queued')
+        journal.submit([(download_id, 'download', None, job)])
+        return
+    journal.submit([(download_id, 'download', None, job)])
+    schedule_download(download_id, job)
+
+
+def schedule_download(download_id, job, enforce_limits=True):
+    """Queue a single download described by its journal request"""
+    def download_job():
+        download_video(job['url'], download_id, job['format_request'],
+                       concurrent_fragments=job['concurrent_fragments'], client=job['client'])
+    
+    scheduler.submit(download_id, download_job, client=job['client'], enforce_limits=enforce_limits)
+
+
+_recovered_pid = None
+recovery_lock = threading.Lock()
+
+
+def recover_jobs():
+    """Once per process, restore recent job records and resume jobs orphaned by a restart
+
+    Unfinished downloads are queued again under their original ID; yt-dlp
+    continues their .part files with Range requests.
+    """
+    global _recovered_pid
+    if _recovered_pid == os.getpid():
+        return
+    with recovery_lock:
+        if _recovered_pid == os.getpid():
+            return
+        _recovered_pid = os.getpid()
+        
+        for download_id, kind, record in journal.finished(time.time() - JOURNAL_RETENTION):
+            if progress_store.get(download_id) is not None:
+                continue
+            if record.get('status') == 'completed' and not os.path.exists(record.get('filepath') or ''):
+                continue
+            progress_store.set(download_id, record)
+        
+        if JOB_RUNNER == 'worker':
+            # Worker processes requeue the jobs of workers that died
+            return
+        batches = {}
+        jobs = journal.claim_unfinished()
+        for download_id, kind, parent, job in jobs:
+            if kind == 'batch_item':
+                batches.setdefault(parent, []).append((download_id, job['url']))
+            else:
+                schedule_download(download_id, job, enforce_limits=False)
+        for batch_id, items in batches.items():
+            params = journal.request(batch_id)
+            if params is None:
+                fail_orphaned_items([download_id for download_id, _ in items])
+                continue
+            start_batch(items, params['format_request'], params['parallelism'],
+                        params['concurrent_fragments'], params['client'])
+        if jobs:
+            app.logger.info('Resuming %d unfinished jobs', len(jobs))
+
+
+def batch_response(batch):
+    """Build the aggregate and per-item progress payload of a batch"""
+    items = []
+    counts = {'completed': 0, 'error': 0}
+    total_progress = 0
+    for item in batch['items']:
+        record = progress_store.get(item['download_id']) or {'progress': 0, 'status': 'expired'}
+        entry = dict(item, progress=record['progress'], status=record['status'])
+        if entry.get('title') is None and record.get('title'):
+            # Video URLs are not extracted up front; their title comes with the download
+            entry['title'] = record['title']
+        if 'error' in record:
+            entry['error'] = record['error']
+        items.append(entry)
+        if record['status'] in counts:
+            counts[record['status']] += 1
+        total_progress += 100 if record['status'] in ('completed', 'error') else record['progress']
+    
+    finished = counts['completed'] + counts['error']
+    return {
+        'success': True,
+        'batch_id': batch['batch_id'],
+        'status': 'completed' if finished == len(items) else 'downloading',
+        'progress': total_progress / len(items) if items else 100,
+        'total': len(items),
+        'completed': counts['completed'],
+        'failed': counts['error'],
+        'items': items,
+    }
+
+
+class ZipStream:
+    """Write-only file object that hands zipfile output to a generator"""
+
+    def __init__(self):
+        self._chunks = []
+        self._written = 0
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._written += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._written
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        chunks, self._chunks = self._chunks, []
+        return b''.join(chunks)
+
+
+def stream_zip(files):
+    """Yield a ZIP archive of (path, arcname) files without staging it on disk
+
+    Entries are stored uncompressed: videos are already compressed, and the
+    archive is produced one file chunk at a time.
+    """
+    out = ZipStream()
+    with zipfile.ZipFile(out, 'w', compression=zipfile.ZIP_STORED, allowZip64=True) as archive:
+        for path, arcname in files:
+            with open(path, 'rb') as src, archive.open(arcname, 'w', force_zip64=True) as dest:
+                while True:
+                    chunk = src.read(STREAM_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    dest.write(chunk)
+                    yield out.drain()
+            yield out.drain()
+    yield out.drain()
 
 
 @app.route('/')
@@ -375,6 +2639,8 @@ def index():
         <script>
             let currentDownloadId = null;
             let progressInterval = null;
+            let progressSource = null;
+            let streamStarted = false;
 
             function formatTime(seconds) {
                 const mins = Math.floor(seconds / 60);
@@ -382,7 +2648,17 @@ def index():
                 return mins + ':' + secs.toString().padStart(2, '0');
             }
 
-            function updateProgressBar(progress, status) {
+            function formatBytes(bytes) {
+                const units = ['B', 'KB', 'MB', 'GB'];
+                let i = 0;
+                while (bytes >= 1024 && i < units.length - 1) {
+                    bytes /= 1024;
+                    i++;
+                }
+                return bytes.toFixed(i ? 1 : 0) + ' ' + units[i];
+            }
+
+            function updateProgressBar(progress, status, queuePosition, data) {
                 const progressBar = document.getElementById('progressBar');
                 const progressText = document.getElementById('progressText');
                 const progressStatus = document.getElementById('progressStatus');
@@ -393,44 +2669,103 @@ def index():
                 progressText.textContent = Math.round(progress) + '%';
                 
                 const statusMessages = {
+                    'queued': 'Waiting in queue' + (queuePosition ? ' (position ' + queuePosition + ')' : '') + '...',
                     'initializing': 'Initializing download...',
                     'fetching_info': 'Fetching video information...',
                     'downloading': 'Downloading video...',
                     'completed': 'Download complete!',
                     'error': 'Error occurred'
                 };
-                progressStatus.textContent = statusMessages[status] || status;
+                let message = statusMessages[status] || status;
+                if (status === 'downloading' && data && data.speed) {
+                    message += ' ' + formatBytes(data.speed) + '/s';
+                    if (data.eta != null) {
+                        message += ', ' + formatTime(Math.round(data.eta)) + ' left';
+                    }
+                }
+                progressStatus.textContent = message;
+            }
+
+            function stopProgressUpdates() {
+                if (progressInterval) {
+                    clearInterval(progressInterval);
+                    progressInterval = null;
+                }
+                if (progressSource) {
+                    progressSource.close();
+                    progressSource = null;
+                }
+            }
+
+            function handleProgress(downloadId, data) {
+                if (data.success) {
+                    updateProgressBar(data.progress, data.status, data.queue_position, data);
+                    
+                    if (data.streamable && !streamStarted) {
+                        // Start receiving the file while the server is still downloading it
+                        streamStarted = true;
+                        document.getElementById('success').textContent = 'Streaming video while it downloads...';
+                        document.getElementById('success').style.display = 'block';
+                        window.location.href = `/api/download/${downloadId}/stream`;
+                    } else if (data.status === 'completed') {
+                        stopProgressUpdates();
+                        document.getElementById('downloadBtn').disabled = false;
+                        if (streamStarted) {
+                            return;
+                        }
+                        document.getElementById('success').textContent = 'Video downloaded successfully! Starting download...';
+                        document.getElementById('success').style.display = 'block';
+                        // Automatically download the file
+                        window.location.href = `/api/download/${downloadId}/file`;
+                    } else if (data.status === 'error') {
+                        stopProgressUpdates();
+                        document.getElementById('downloadBtn').disabled = false;
+                        const errorMsg = data.error || 'Download failed';
+                        document.getElementById('error').textContent = 'Error: ' + errorMsg;
+                        document.getElementById('error').style.display = 'block';
+                        document.getElementById('progressContainer').style.display = 'none';
+                    }
+                }
             }
 
             function checkProgress(downloadId) {
                 fetch(`/api/progress/${downloadId}`)
                     .then(response => response.json())
-                    .then(data => {
-                        if (data.success) {
-                            updateProgressBar(data.progress, data.status);
-                            
-                            if (data.status === 'completed') {
-                                clearInterval(progressInterval);
-                                document.getElementById('downloadBtn').disabled = false;
-                                document.getElementById('success').textContent = 'Video downloaded successfully! Starting download...';
-                                document.getElementById('success').style.display = 'block';
-                                // Automatically download the file
-                                window.location.href = `/api/download/${downloadId}/file`;
-                            } else if (data.status === 'error') {
-                                clearInterval(progressInterval);
-                                document.getElementById('downloadBtn').disabled = false;
-                                const errorMsg = data.error || 'Download failed';
-                                document.getElementById('error').textContent = 'Error: ' + errorMsg;
-                                document.getElementById('error').style.display = 'block';
-                                document.getElementById('progressContainer').style.display = 'none';
-                            }
-                        }
-                    })
+                    .then(data => handleProgress(downloadId, data))
                     .catch(error => {
                         console.error('Progress check error:', error);
                     });
             }
 
+            function startPolling(downloadId) {
+                progressInterval = setInterval(() => {
+                    checkProgress(downloadId);
+                }, 500);
+                
+                // Also check immediately
+                checkProgress(downloadId);
+            }
+
+            function watchProgress(downloadId) {
+                // Prefer the server-pushed stream; fall back to polling if it is unavailable
+                if (!window.EventSource) {
+                    startPolling(downloadId);
+                    return;
+                }
+                progressSource = new EventSource(`/api/progress/${downloadId}/stream`);
+                progressSource.onmessage = (event) => {
+                    handleProgress(downloadId, JSON.parse(event.data));
+                };
+                progressSource.onerror = () => {
+                    if (!progressSource) {
+                        return;
+                    }
+                    progressSource.close();
+                    progressSource = null;
+                    startPolling(downloadId);
+                };
+            }
+
             document.getElementById('downloadForm').addEventListener('submit', async (e) => {
                 e.preventDefault();
                 const url = document.getElementById('url').value;
@@ -445,10 +2780,9 @@ def index():
                 successDiv.style.display = 'none';
                 downloadBtn.disabled = true;
                 
-                // Clear any existing progress interval
-                if (progressInterval) {
-                    clearInterval(progressInterval);
-                }
+                // Stop following any previous download
+                stopProgressUpdates();
+                streamStarted = false;
                 
                 try {
                     // First get video info
@@ -490,13 +2824,8 @@ def index():
                     currentDownloadId = downloadData.download_id;
                     updateProgressBar(0, 'initializing');
                     
-                    // Start polling for progress
-                    progressInterval = setInterval(() => {
-                        checkProgress(currentDownloadId);
-                    }, 500);
-                    
-                    // Also check immediately
-                    checkProgress(currentDownloadId);
+                    // Follow progress
+                    watchProgress(currentDownloadId);
                     
                 } catch (error) {
                     errorDiv.textContent = 'Error: ' + error.message;
@@ -510,6 +2839,13 @@ def index():
     '''
 
 
+def upstream_busy_response(exc):
+    """503 telling the client when the upstream circuit breaker closes"""
+    response = jsonify({'success': False, 'error': str(exc)})
+    response.headers['Retry-After'] = str(exc.retry_after)
+    return response, 503
+
+
 @app.route('/api/info', methods=['GET'])
 def api_info():
     """API endpoint to get video information"""
@@ -518,7 +2854,10 @@ def api_info():
     if not url:
         return jsonify({'success': False, 'error': 'URL parameter is required'}), 400
     
-    video_info, error = get_video_info(url)
+    try:
+        video_info, error = get_video_info(url)
+    except UpstreamBusy as e:
+        return upstream_busy_response(e)
     
     if error:
         return jsonify({'success': False, 'error': error}), 400
@@ -531,81 +2870,422 @@ def api_download():
     """API endpoint to start video download"""
     data = request.get_json()
     url = data.get('url') if data else None
-    quality = data.get('quality', 'highest') if data else 'highest'
     
     if not url:
         return jsonify({'success': False, 'error': 'URL parameter is required'}), 400
     
+    try:
+        format_request = parse_format_request(data)
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    concurrent_fragments = parse_concurrent_fragments(data)
+    
+    # Refuse before queueing while upstream is backing off or the video recently failed
+    try:
+        upstream_breaker.check()
+        check_failure_cache(canonical_video_id(url))
+    except UpstreamBusy as e:
+        return upstream_busy_response(e)
+    except ExtractionFailed as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    
     # Generate download ID
     download_id = str(uuid.uuid4())
-    update_progress(download_id, 0, 'initializing')
     
-    # Start download in background thread
-    def download_thread():
-        download_video(url, download_id, quality=quality)
-    
-    thread = threading.Thread(target=download_thread)
-    thread.daemon = True
-    thread.start()
+    # Journaled first, so a restart or a worker process can pick the job up
+    job = {
+        'url': url,
+        'format_request': format_request,
+        'concurrent_fragments': concurrent_fragments,
+        'client': request.remote_addr,
+    }
+    try:
+        submit_download(download_id, job)
+    except QueueFull as e:
+        journal.set_state(download_id, 'rejected')
+        response = jsonify({'success': False, 'error': str(e)})
+        response.headers['Retry-After'] = str(e.retry_after)
+        return response, 429
     
     return jsonify({'success': True, 'download_id': download_id})
 
 
+@app.route('/api/batch', methods=['POST'])
+def api_batch():
+    """API endpoint to download many videos, or every video of a playlist or channel"""
+    data = request.get_json() or {}
+    urls = data.get('urls') or ([data['url']] if data.get('url') else [])
+    
+    if not urls or not isinstance(urls, list):
+        return jsonify({'success': False, 'error': 'url or urls parameter is required'}), 400
+    
+    try:
+        parallelism = int(data.get('parallelism', BATCH_PARALLELISM))
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'error': 'parallelism must be an integer'}), 400
+    parallelism = max(1, min(parallelism, MAX_BATCH_PARALLELISM))
+    try:
+        format_request = parse_format_request(data)
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    if format_request['format_id']:
+        return jsonify({'success': False, 'error': 'format_id is per video; use a height, codec or size budget'}), 400
+    if format_request['clip']:
+        return jsonify({'success': False, 'error': 'Clips are per video; use /api/download'}), 400
+    concurrent_fragments = parse_concurrent_fragments(data)
+    client = request.remote_addr
+    
+    try:
+        admit_jobs(client, jobs=parallelism)
+        upstream_breaker.check()
+        expanded = expand_urls(urls)
+    except QueueFull as e:
+        response = jsonify({'success': False, 'error': str(e)})
+        response.headers['Retry-After'] = str(e.retry_after)
+        return response, 429
+    except UpstreamBusy as e:
+        return upstream_busy_response(e)
+    except Exception as e:
+        if classify_failure(e) == 'rate_limited':
+            upstream_breaker.trip()
+        return jsonify({'success': False, 'error': str(e)}), 400
+    
+    if not expanded:
+        return jsonify({'success': False, 'error': 'No videos found'}), 400
+    
+    batch_id = str(uuid.uuid4())
+    items = [{'download_id': str(uuid.uuid4()), 'url': url, 'title': title} for url, title in expanded]
+    batch = {'batch_id': batch_id, 'items': items, 'status': 'batch', 'progress': 0, 'timestamp': time.time()}
+    progress_store.set(batch_id, batch)
+    params = {
+        'format_request': format_request,
+        'parallelism': parallelism,
+        'concurrent_fragments': concurrent_fragments,
+        'client': client,
+    }
+    if JOB_RUNNER == 'worker':
+        # Worker processes take the items from the journal
+        for item in items:
+            update_progress(item['download_id'], 0, 'queued')
+    journal.submit([(batch_id, 'batch', None, params)] +
+                   [(item['download_id'], 'batch_item', batch_id, {'url': item['url'], 'client': client})
+                    for item in items])
+    journal.set_state(batch_id, 'batch', batch)
+    if JOB_RUNNER != 'worker':
+        start_batch([(item['download_id'], item['url']) for item in items],
+                    format_request, parallelism, concurrent_fragments, client)
+    
+    return jsonify({'success': True, 'batch_id': batch_id, 'items': items})
+
+
+@app.route('/api/batch/<batch_id>', methods=['GET'])
+def api_batch_progress(batch_id):
+    """API endpoint to get aggregate and per-item progress of a batch"""
+    batch = progress_store.get(batch_id)
+    if not batch or batch.get('status') != 'batch':
+        return jsonify({'success': False, 'error': 'Batch ID not found'}), 404
+    
+    return jsonify(batch_response(batch))
+
+
+@app.route('/api/batch/<batch_id>/zip', methods=['GET'])
+def api_batch_zip(batch_id):
+    """API endpoint to stream the finished files of a batch as one ZIP archive"""
+    batch = progress_store.get(batch_id)
+    if not batch or batch.get('status') != 'batch':
+        return jsonify({'success': False, 'error': 'Batch ID not found'}), 404
+    
+    summary = batch_response(batch)
+    if summary['status'] != 'completed':
+        return jsonify({'success': False, 'error': 'Batch not completed'}), 409
+    
+    files = []
+    names = set()
+    for item in summary['items']:
+        record = progress_store.get(item['download_id'])
+        if not record or record['status'] != 'completed' or not os.path.exists(record.get('filepath', '')):
+            continue
+        name = secure_filename(record.get('download_name') or os.path.basename(record['filepath']))
+        base, ext = os.path.splitext(name)
+        counter = 1
+        while name in names:
+            counter += 1
+            name = f'{base}-{counter}{ext}'
+        names.add(name)
+        files.append((item['download_id'], record['filepath'], name))
+    
+    if not files:
+        return jsonify({'success': False, 'error': 'No files downloaded'}), 404
+    
+    # Pin every file for as long as the archive is streaming
+    for download_id, filepath, _ in files:
+        transfer_started(download_id, filepath)
+    
+    def generate():
+        try:
+            for chunk in stream_zip([(filepath, name) for _, filepath, name in files]):
+                served_bytes_total.inc(len(chunk), endpoint='batch_zip')
+                yield chunk
+        finally:
+            for download_id, filepath, _ in files:
+                transfer_finished(download_id, filepath)
+    
+    response = Response(generate(), mimetype='application/zip', headers={
+        'Content-Disposition': f'attachment; filename="batch-{batch_id[:8]}.zip"',
+    })
+    return throttle_response(response, batch_id)
+
+
 @app.route('/api/download/<download_id>/file', methods=['GET'])
 def api_download_file(download_id):
     """API endpoint to get the downloaded file"""
-    with progress_lock:
-        progress_data = download_progress.get(download_id)
-        filepath = download_files.get(download_id)
+    progress_data = progress_store.get(download_id)
+    
+    if not progress_data or progress_data['status'] != 'completed':
+        return jsonify({'success': False, 'error': 'Download not completed'}), 404
+    
+    filepath = progress_data.get('filepath')
+    if not filepath or not os.path.exists(filepath):
+        return jsonify({'success': False, 'error': 'File not found'}), 404
+    
+    download_name = progress_data.get('download_name') or os.path.basename(filepath)
+    audio_only = progress_data.get('mode') == 'audio'
+    
+    # Keep the file and job alive for as long as any transfer is open
+    transfer_started(download_id, filepath)
+    if progress_data.get('remux'):
+        # Remuxed output is produced while it is sent, so it has no length and no ranges
+        target = progress_data['remux']
         
-        if not progress_data or progress_data['status'] != 'completed':
-            return jsonify({'success': False, 'error': 'Download not completed'}), 404
+        def generate():
+            for chunk in remux_pipe(filepath, target, progress_data.get('mode', 'video')):
+                served_bytes_total.inc(len(chunk), endpoint='file')
+                yield chunk
         
-        if not filepath or not os.path.exists(filepath):
-            return jsonify({'success': False, 'error': 'File not found'}), 404
+        response = Response(generate(), mimetype=container_mimetype(target, audio_only), headers={
+            'Content-Disposition': f'attachment; filename="{secure_filename(download_name)}"',
+            'Accept-Ranges': 'none',
+        })
+        response.call_on_close(lambda: transfer_finished(download_id, filepath))
+        return throttle_response(response, download_id)
     
     try:
-        return send_file(
+        # conditional=True answers Range (206) and If-None-Match/If-Modified-Since
+        # requests, so clients can resume or fetch segments in parallel. The ETag
+        # pairs the cache key digest (the file name) with the file's identity, so
+        # a re-download under the same key is a new entity, as with send_file's own.
+        stat = os.stat(filepath)
+        etag = '{}-{:x}-{:x}-{:x}'.format(os.path.splitext(os.path.basename(filepath))[0],
+                                         stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        response = send_file(
             filepath,
             as_attachment=True,
-            download_name=os.path.basename(filepath),
-            mimetype='video/mp4'
+            download_name=download_name,
+            mimetype=container_mimetype(os.path.splitext(filepath)[1][1:], audio_only),
+            conditional=True,
+            etag=etag
         )
-    finally:
-        # Clean up file after sending (with delay to ensure download started)
-        def cleanup_file():
-            time.sleep(10)  # Wait 10 seconds before cleanup
-            if os.path.exists(filepath):
-                try:
-                    os.remove(filepath)
-                except:
-                    pass
-            with progress_lock:
-                download_progress.pop(download_id, None)
-                download_files.pop(download_id, None)
-        
-        cleanup_thread = threading.Thread(target=cleanup_file)
-        cleanup_thread.daemon = True
-        cleanup_thread.start()
+    except Exception:
+        transfer_finished(download_id, filepath)
+        raise
+    response.headers['Accept-Ranges'] = 'bytes'
+    # Counted up front from the (range-adjusted) length; sendfile keeps the body opaque
+    if response.status_code != 304 and request.method != 'HEAD':
+        served_bytes_total.inc(response.content_length or 0, endpoint='file')
+    throttle_response(response, download_id)
+    release_on_close(response, lambda: transfer_finished(download_id, filepath))
+    return response
+
+
+def progress_response(progress_data):
+    """Build the public progress payload from a job record"""
+    response = {
+        'success': True,
+        'progress': progress_data['progress'],
+        'status': progress_data['status']
+    }
+    if 'error' in progress_data:
+        response['error'] = progress_data['error']
+    if progress_data['status'] == 'queued':
+        response['queue_position'] = progress_data.get('queue_position')
+    for key in PROGRESS_STATS:
+        if progress_data.get(key) is not None:
+            response[key] = progress_data[key]
+    if progress_data.get('streamable') and progress_data['status'] != 'completed':
+        response['streamable'] = True
+    if progress_data.get('clip'):
+        response['clip'] = progress_data['clip']
+    return response
+
+
+def is_meaningful_change(previous, current):
+    """Whether a progress update is worth pushing to a stream"""
+    if previous is None:
+        return True
+    # Transfer stats change on every update, so they only ride along
+    ignored = ('progress',) + PROGRESS_STATS
+    if {k: v for k, v in previous.items() if k not in ignored} != \
+            {k: v for k, v in current.items() if k not in ignored}:
+        return True
+    return abs(current['progress'] - previous['progress']) >= SSE_MIN_PROGRESS_DELTA
+
+
+def follow_file(download_id, record, fileobj):
+    """Yield a download's bytes as yt-dlp writes them, until the job finishes
+
+    Reading stops at the current end of file and resumes when the job reports
+    progress, so at most one chunk is buffered and a slow client simply slows
+    the reads. yt-dlp renames the .part file when it finishes, which does not
+    affect the already open file object.
+    """
+    with fileobj:
+        while True:
+            chunk = fileobj.read(STREAM_CHUNK_SIZE)
+            if chunk:
+                served_bytes_total.inc(len(chunk), endpoint='stream')
+                yield chunk
+                continue
+            if record is None or record['status'] == 'error':
+                # Abort the connection so the client sees an incomplete transfer
+                raise IOError(f'Download {download_id} failed while streaming')
+            if record['status'] == 'completed':
+                return
+            record = progress_store.wait_for_change(download_id, record, STREAM_POLL_INTERVAL)
+
+
+@app.route('/api/download/<download_id>/stream', methods=['GET'])
+def api_download_stream(download_id):
+    """API endpoint to stream a video while it is still downloading"""
+    # Wait until the job has a file to read (it may still be queued or extracting)
+    record = progress_store.get(download_id)
+    deadline = time.monotonic() + STREAM_START_TIMEOUT
+    while record and record['status'] != 'error' and not (
+            record.get('filepath') or record.get('partial_path')):
+        if record['status'] == 'downloading' and record.get('streamable') is False:
+            break
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return jsonify({'success': False, 'error': 'Download has not started yet'}), 503
+        record = progress_store.wait_for_change(download_id, record, remaining)
+    
+    if not record:
+        return jsonify({'success': False, 'error': 'Download ID not found'}), 404
+    if record['status'] == 'error':
+        return jsonify({'success': False, 'error': record.get('error', 'Download failed')}), 400
+    
+    path = record.get('filepath') if record['status'] == 'completed' else record.get('partial_path')
+    if not path or (record['status'] != 'completed' and not record.get('streamable')):
+        return jsonify({'success': False,
+                        'error': 'This format is merged after download; fetch the file when completed'}), 409
+    
+    try:
+        fileobj = open(path, 'rb')
+    except FileNotFoundError:
+        # The .part file was renamed in between; the finished file has it all
+        record = progress_store.wait_for_change(download_id, record, STREAM_START_TIMEOUT)
+        if not record or not record.get('filepath'):
+            return jsonify({'success': False, 'error': 'File not found'}), 404
+        fileobj = open(record['filepath'], 'rb')
+    
+    download_name = record.get('download_name') or 'video.mp4'
+    mimetype = container_mimetype(os.path.splitext(download_name)[1][1:], record.get('mode') == 'audio')
+    response = Response(follow_file(download_id, record, fileobj), mimetype=mimetype, headers={
+        'Content-Disposition': f'attachment; filename="{secure_filename(download_name)}"',
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+    })
+    return throttle_response(response, download_id)
 
 
 @app.route('/api/progress/<download_id>', methods=['GET'])
 def api_progress(download_id):
     """API endpoint to get download progress"""
-    with progress_lock:
-        progress_data = download_progress.get(download_id)
-        if not progress_data:
-            return jsonify({'success': False, 'error': 'Download ID not found'}), 404
-        
-        response = {
-            'success': True,
-            'progress': progress_data['progress'],
-            'status': progress_data['status']
-        }
-        if 'error' in progress_data:
-            response['error'] = progress_data['error']
-        
-        return jsonify(response)
+    progress_data = progress_store.get(download_id)
+    if not progress_data:
+        return jsonify({'success': False, 'error': 'Download ID not found'}), 404
+    
+    response = progress_response(progress_data)
+    # File responses are paced by the process serving them, so only its own show up
+    response.update({key: value for key, value in egress_budget.job_rates(download_id).items()
+                     if value is not None})
+    return jsonify(response)
+
+
+@app.route('/api/progress/<download_id>/stream', methods=['GET'])
+def api_progress_stream(download_id):
+    """API endpoint streaming download progress as Server-Sent Events"""
+    progress_data = progress_store.get(download_id)
+    if not progress_data:
+        return jsonify({'success': False, 'error': 'Download ID not found'}), 404
+    
+    def generate():
+        record = progress_data
+        last_sent = None
+        last_sent_at = 0
+        while True:
+            if record is None:
+                yield 'data: ' + json.dumps({'success': False, 'error': 'Download ID not found'}) + '\n\n'
+                return
+            
+            response = progress_response(record)
+            if is_meaningful_change(last_sent, response):
+                # Intermediate updates are coalesced: only the latest record is sent
+                delay = SSE_MIN_INTERVAL - (time.monotonic() - last_sent_at)
+                if delay > 0 and response['status'] not in ('completed', 'error'):
+                    record = progress_store.wait_for_change(download_id, record, delay)
+                    continue
+                yield 'data: ' + json.dumps(response) + '\n\n'
+                last_sent = response
+                last_sent_at = time.monotonic()
+            
+            if response['status'] in ('completed', 'error'):
+                return
+            
+            latest = progress_store.wait_for_change(download_id, record, SSE_KEEPALIVE)
+            if latest == record:
+                yield ': keepalive\n\n'
+            record = latest
+    
+    return Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+    })
+
+
+def job_speeds():
+    """Current download speed of every downloading job, plus their total"""
+    speeds = {}
+    for download_id, record in progress_store.records():
+        if record.get('status') == 'downloading' and record.get('speed'):
+            speeds[(('download_id', download_id),)] = record['speed']
+    speeds[(('download_id', 'all'),)] = sum(speeds.values())
+    return speeds
+
+
+metrics.register(Gauge('ytdl_download_speed_bytes_per_second',
+                       'Current download throughput per job and in aggregate (download_id="all")',
+                       job_speeds))
+metrics.register(Gauge('ytdl_queue_depth', 'Jobs waiting for a download worker',
+                       lambda: {(): journal.count('queued') if JOB_RUNNER == 'worker' else scheduler.queue_depth()}))
+metrics.register(Gauge('ytdl_active_jobs', 'Jobs being downloaded by a worker',
+                       lambda: {(): journal.count('running') if JOB_RUNNER == 'worker' else scheduler.active}))
+metrics.register(Gauge('ytdl_player_client_score', 'Moving average of extraction success per YouTube player client',
+                       lambda: {(('client', client),): score for client, score in player_clients.scores.items()}))
+metrics.register(Gauge('ytdl_upstream_backoff_seconds', 'Seconds until the upstream circuit breaker closes',
+                       lambda: {(): upstream_breaker.retry_after()}))
+metrics.register(Gauge('ytdl_cache_bytes', 'Size of the download cache',
+                       lambda: {(): download_cache.total_bytes()}))
+metrics.register(Gauge('ytdl_cookie_session_active_jobs', 'Jobs using each cookie session',
+                       lambda: {(('session', s.name),): s.active for s in cookie_pool.sessions}))
+metrics.register(Gauge('ytdl_cookie_session_cooldown_seconds', 'Seconds until each cookie session is used again',
+                       lambda: {(('session', s.name),): max(0, s.cooldown_until - time.time())
+                                for s in cookie_pool.sessions}))
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Prometheus metrics for this process"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
 
 @app.route('/health', methods=['GET'])
@@ -614,6 +3294,18 @@ def health():
     return jsonify({'status': 'healthy'}), 200
 
 
+def create_app():
+    """App factory for preloading servers: gunicorn 'app:create_app()' --preload
+
+    Warms up in the master, then freezes the heap so the garbage collector
+    does not dirty the shared pages; workers share them copy-on-write.
+    """
+    warm_up()
+    gc.collect()
+    gc.freeze()
+    return app
+
+
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
-    app.run(host='0.0.0.0', port=port, debug=False)
+    create_app().run(host='0.0.0.0', port=port, debug=False)
@@ -0,0 +1,295 @@
+"""ASGI entry point: serves the Flask app without pinning a worker per transfer
+
+    pip install uvicorn
+    uvicorn asgi:application --host 0.0.0.0 --port $PORT --workers 2
+
+Routes run unchanged in a thread pool, but their responses are sent from the
+event loop: file responses (send_file, including Range responses) go out with
+the server's pathsend/zerocopysend extension when it has one and as async
+chunked reads otherwise, and progress event streams are served natively.
+A slow client therefore costs a socket and a file descriptor, not a thread.
+"""
+import asyncio
+import io
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.http import parse_content_range_header
+from werkzeug.wsgi import FileWrapper
+
+import app as downloader
+from app import app, progress_store, progress_response, is_meaningful_change, ThrottledBody
+
+# Threads running Flask views (extraction requests block for seconds)
+ASGI_THREADS = int(os.environ.get('ASGI_THREADS', 32))
+
+# How often native progress streams check a job for changes
+ASGI_POLL_INTERVAL = float(os.environ.get('ASGI_POLL_INTERVAL', 0.25))
+
+executor = ThreadPoolExecutor(ASGI_THREADS, thread_name_prefix='wsgi')
+
+
+class ZeroCopyFile(FileWrapper):
+    """wsgi.file_wrapper that marks send_file bodies for native sending"""
+
+
+def file_segment(body, status, headers, wrappers):
+    """Return (file, offset, count) if a WSGI body is a plain file, else None
+
+    count is None for "to the end of the file". A Range response (206) wraps
+    the file the view opened; its span is read from the Content-Range header.
+    Throttled bodies are paced by the app, so they are sent chunk by chunk.
+    """
+    if len(wrappers) != 1:
+        return None
+    wrapper = wrappers[0]
+    if body is wrapper:
+        return wrapper.file, wrapper.file.tell(), None
+    if status == 206 and not isinstance(body, ThrottledBody):
+        content_range = parse_content_range_header(dict(headers).get(b'content-range', b'').decode('latin-1'))
+        if content_range and content_range.units == 'bytes' and content_range.start is not None:
+            return wrapper.file, content_range.start, content_range.stop - content_range.start
+    return None
+
+
+def build_environ(scope, body, wrappers):
+    """Translate an ASGI HTTP scope and request body into a WSGI environ
+
+    Files the app hands to wsgi.file_wrapper are collected in `wrappers`.
+    """
+    def file_wrapper(*args):
+        wrapper = ZeroCopyFile(*args)
+        wrappers.append(wrapper)
+        return wrapper
+
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1] or 80),
+        'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+        'wsgi.file_wrapper': file_wrapper,
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_TYPE':
+            environ['CONTENT_TYPE'] = value
+        elif name != 'CONTENT_LENGTH':
+            key = 'HTTP_' + name
+            environ[key] = f'{environ[key]},{value}' if key in environ else value
+    return environ
+
+
+async def read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            return b''.join(chunks)
+
+
+class Disconnect:
+    """Watches receive() so long responses stop when the client goes away"""
+
+    def __init__(self, receive):
+        self.is_set = False
+        self._task = asyncio.ensure_future(self._watch(receive))
+
+    async def _watch(self, receive):
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+        self.is_set = True
+
+    def cancel(self):
+        self._task.cancel()
+
+
+async def send_file_segment(scope, send, disconnect, segment):
+    """Send a file span with the server's zero-copy extension or async reads"""
+    fileobj, offset, count = segment
+    extensions = scope.get('extensions') or {}
+    whole_file = offset == 0 and count is None
+    if count is None:
+        count = os.fstat(fileobj.fileno()).st_size - offset
+    if 'http.response.zerocopysend' in extensions:
+        await send({'type': 'http.response.zerocopysend', 'file': fileobj.fileno(),
+                    'offset': offset, 'count': count})
+        return
+    if 'http.response.pathsend' in extensions and whole_file and isinstance(getattr(fileobj, 'name', None), str):
+        await send({'type': 'http.response.pathsend', 'path': os.path.abspath(fileobj.name)})
+        return
+
+    loop = asyncio.get_running_loop()
+    fd = fileobj.fileno()
+    end = offset + count
+    while offset < end and not disconnect.is_set:
+        chunk = await loop.run_in_executor(
+            None, os.pread, fd, min(downloader.STREAM_CHUNK_SIZE, end - offset), offset)
+        if not chunk:
+            break
+        offset += len(chunk)
+        await send({'type': 'http.response.body', 'body': chunk, 'more_body': offset < end})
+    if offset < end:
+        # Short file or client gone: end the response (the server drops the connection)
+        await send({'type': 'http.response.body', 'body': b''})
+
+
+async def call_wsgi(scope, receive, send):
+    """Run the Flask app in the thread pool and send its response from the loop"""
+    body = await read_body(receive)
+    if body is None:
+        return
+    loop = asyncio.get_running_loop()
+    wrappers = []
+    environ = build_environ(scope, body, wrappers)
+    started = {}
+
+    def start_response(status, headers, exc_info=None):
+        started['status'] = int(status.split(' ', 1)[0])
+        started['headers'] = [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                              for name, value in headers]
+
+    app_iter = await loop.run_in_executor(executor, app, environ, start_response)
+    disconnect = Disconnect(receive)
+    try:
+        segment = file_segment(app_iter, started.get('status'), started.get('headers', []), wrappers)
+        iterator = None
+        first = b''
+        if segment is None:
+            # Generators may only call start_response on their first chunk
+            iterator = iter(app_iter)
+            first = await loop.run_in_executor(executor, next, iterator, None)
+        await send({'type': 'http.response.start', 'status': started['status'],
+                    'headers': started['headers']})
+        if segment is not None:
+            await send_file_segment(scope, send, disconnect, segment)
+            return
+
+        chunk = first
+        while chunk is not None and not disconnect.is_set:
+            if chunk:
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            chunk = await loop.run_in_executor(executor, next, iterator, None)
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        disconnect.cancel()
+        close = getattr(app_iter, 'close', None)
+        if close:
+            await loop.run_in_executor(executor, close)
+
+
+async def wait_for_change(download_id, last, timeout):
+    """Async counterpart of ProgressStore.wait_for_change (polls the store)"""
+    deadline = time.monotonic() + timeout
+    while True:
+        record = progress_store.get(download_id)
+        remaining = deadline - time.monotonic()
+        if record != last or remaining <= 0:
+            return record
+        await asyncio.sleep(min(ASGI_POLL_INTERVAL, remaining))
+
+
+async def send_json(send, status, payload):
+    body = json.dumps(payload).encode('utf-8')
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', b'application/json'),
+                            (b'content-length', str(len(body)).encode('ascii'))]})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def progress_stream(scope, receive, send, download_id):
+    """Native version of /api/progress/<id>/stream (same events as the Flask route)"""
+    record = progress_store.get(download_id)
+    if not record:
+        await send_json(send, 404, {'success': False, 'error': 'Download ID not found'})
+        return
+
+    await send({'type': 'http.response.start', 'status': 200, 'headers': [
+        (b'content-type', b'text/event-stream; charset=utf-8'),
+        (b'cache-control', b'no-cache'),
+        (b'x-accel-buffering', b'no'),
+    ]})
+    disconnect = Disconnect(receive)
+
+    async def emit(text):
+        await send({'type': 'http.response.body', 'body': text.encode('utf-8'), 'more_body': True})
+
+    try:
+        last_sent = None
+        last_sent_at = 0
+        while not disconnect.is_set:
+            if record is None:
+                await emit('data: ' + json.dumps({'success': False, 'error': 'Download ID not found'}) + '\n\n')
+                break
+
+            response = progress_response(record)
+            if is_meaningful_change(last_sent, response):
+                # Intermediate updates are coalesced: only the latest record is sent
+                delay = downloader.SSE_MIN_INTERVAL - (time.monotonic() - last_sent_at)
+                if delay > 0 and response['status'] not in ('completed', 'error'):
+                    record = await wait_for_change(download_id, record, delay)
+                    continue
+                await emit('data: ' + json.dumps(response) + '\n\n')
+                last_sent = response
+                last_sent_at = time.monotonic()
+
+            if response['status'] in ('completed', 'error'):
+                break
+
+            latest = await wait_for_change(download_id, record, downloader.SSE_KEEPALIVE)
+            if latest == record:
+                await emit(': keepalive\n\n')
+            record = latest
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        disconnect.cancel()
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            downloader.janitor.start()
+            downloader.recover_jobs()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            executor.shutdown(wait=False)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    """ASGI application"""
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+
+    parts = scope['path'].strip('/').split('/')
+    if (scope['method'] == 'GET' and len(parts) == 4
+            and parts[:2] == ['api', 'progress'] and parts[3] == 'stream'):
+        await progress_stream(scope, receive, send, parts[2])
+        return
+    await call_wsgi(scope, receive, send)
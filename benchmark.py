@@ -0,0 +1,454 @@
+"""Load-test the downloader against a local fake video origin
+
+Starts the Flask app in-process next to a local HTTP origin serving synthetic
+MP4 files (progressive, or DASH fragments), with a stub extractor so yt-dlp
+resolves benchmark URLs to that origin without network access. Runs N
+download + progress + file-fetch cycles at a given concurrency and prints a
+JSON report (latency percentiles, throughput, peak RSS, open file descriptors).
+
+    python benchmark.py --cycles 50 --concurrency 8 --output run.json
+
+With --startup it instead reports cold start time and per-worker memory for
+each EXTRACTORS setting, with and without preloading (create_app + fork).
+"""
+import argparse
+import json
+import logging
+import os
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def synthetic_media(size):
+    """Bytes that start like an MP4 file (ftyp box) followed by filler"""
+    header = b'\x00\x00\x00\x18ftypisom\x00\x00\x02\x00isomiso2'
+    filler = bytes(range(256)) * (size // 256 + 1)
+    return (header + filler)[:size]
+
+
+class OriginHandler(BaseHTTPRequestHandler):
+    """Serves /media/<id>.mp4 and /media/<id>/seg-<n>.m4s with Range support"""
+
+    protocol_version = 'HTTP/1.1'
+    media = b''
+    segments = 1
+    rate = 0  # bytes per second per connection, 0 for unlimited
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        body = self.media
+        match = re.match(r'^/media/[\w-]+/seg-(\d+)\.m4s$', self.path)
+        if match:
+            index = int(match.group(1))
+            size = -(-len(body) // self.segments)
+            body = body[index * size:(index + 1) * size]
+        elif not re.match(r'^/media/[\w-]+\.mp4$', self.path):
+            self.send_error(404)
+            return
+
+        start, end = 0, len(body) - 1
+        range_match = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+        if range_match:
+            start = int(range_match.group(1))
+            if range_match.group(2):
+                end = min(int(range_match.group(2)), end)
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{len(body)}')
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', 'video/mp4')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+
+        chunk = 64 * 1024
+        for offset in range(start, end + 1, chunk):
+            piece = body[offset:min(offset + chunk, end + 1)]
+            try:
+                self.wfile.write(piece)
+            except OSError:
+                return
+            if self.rate:
+                time.sleep(len(piece) / self.rate)
+
+
+def start_origin(size, segments, rate):
+    handler = type('Handler', (OriginHandler,), {
+        'media': synthetic_media(size), 'segments': segments, 'rate': rate})
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def make_stub_extractor(origin, size, mode, segments):
+    """InfoExtractor resolving http://127.0.0.1:<port>/watch?v=<id> to the origin"""
+    from yt_dlp.extractor.common import InfoExtractor
+
+    class BenchmarkIE(InfoExtractor):
+        IE_NAME = 'benchmark'
+        _VALID_URL = r'https?://127\.0\.0\.1:\d+/watch\?v=(?P<id>[\w-]+)'
+
+        def _real_extract(self, url):
+            video_id = self._match_id(url)
+            fmt = {
+                'format_id': 'dash' if mode == 'dash' else '18',
+                'ext': 'mp4',
+                'vcodec': 'avc1.42001E',
+                'acodec': 'mp4a.40.2',
+                'height': 360,
+                'filesize': size,
+            }
+            if mode == 'dash':
+                fmt.update({
+                    'url': f'{origin}/media/{video_id}/',
+                    'protocol': 'http_dash_segments',
+                    'fragment_base_url': f'{origin}/media/{video_id}/',
+                    'fragments': [{'path': f'seg-{index}.m4s', 'duration': 1.0} for index in range(segments)],
+                })
+            else:
+                fmt['url'] = f'{origin}/media/{video_id}.mp4'
+            return {
+                'id': video_id,
+                'title': f'Benchmark {video_id}',
+                'duration': segments,
+                'formats': [fmt],
+            }
+
+    return BenchmarkIE
+
+
+class NullLogger:
+    """yt-dlp logger that drops output, keeping stdout clean for the report"""
+
+    def debug(self, msg):
+        pass
+
+    info = warning = error = debug
+
+
+def install_stub_extractor(app_module, ie_class):
+    """Make pooled YoutubeDL handles try the stub extractor first"""
+    create = app_module.ydl_pool._create
+
+    def create_with_stub(*args):
+        ydl = create(*args)
+        ydl.params['logger'] = NullLogger()
+        ydl.add_info_extractor(ie_class(ydl))
+        ydl._ies = {ie_class.ie_key(): ydl._ies.pop(ie_class.ie_key()), **ydl._ies}
+        return ydl
+
+    app_module.ydl_pool._create = create_with_stub
+
+
+def start_app(app_module):
+    from werkzeug.serving import make_server
+    server = make_server('127.0.0.1', 0, app_module.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class ResourceSampler:
+    """Samples RSS and open file descriptors of this process in the background"""
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak_fds = 0
+        self.peak_rss = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    @staticmethod
+    def open_fds():
+        return len(os.listdir('/proc/self/fd'))
+
+    @staticmethod
+    def rss():
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak_fds = max(self.peak_fds, self.open_fds())
+            self.peak_rss = max(self.peak_rss, self.rss())
+            self._stop.wait(self.interval)
+
+
+def request_json(url, payload=None):
+    headers = {}
+    data = None
+    if payload is not None:
+        data = json.dumps(payload).encode('utf-8')
+        headers['Content-Type'] = 'application/json'
+    req = urllib.request.Request(url, data=data, headers=headers)
+    try:
+        with urllib.request.urlopen(req) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read() or b'{}')
+
+
+def run_cycle(base, video_url, poll_interval, timeout):
+    """POST a download, poll progress until it finishes, then fetch the file"""
+    timings = {}
+    start = time.perf_counter()
+
+    while True:
+        status, body = request_json(f'{base}/api/download', {'url': video_url})
+        if status != 429:
+            break
+        time.sleep(poll_interval)
+    timings['submit'] = time.perf_counter() - start
+    if status != 200 or not body.get('success'):
+        return {'ok': False, 'error': body.get('error', f'HTTP {status}'), **timings}
+    download_id = body['download_id']
+
+    deadline = start + timeout
+    while True:
+        status, body = request_json(f'{base}/api/progress/{download_id}')
+        if body.get('status') in ('completed', 'error') or time.perf_counter() > deadline:
+            break
+        time.sleep(poll_interval)
+    timings['ready'] = time.perf_counter() - start
+    if body.get('status') != 'completed':
+        return {'ok': False, 'error': body.get('error', 'timed out'), **timings}
+
+    fetch_start = time.perf_counter()
+    nbytes = 0
+    with urllib.request.urlopen(f'{base}/api/download/{download_id}/file') as response:
+        timings['ttfb'] = time.perf_counter() - fetch_start
+        while True:
+            chunk = response.read(256 * 1024)
+            if not chunk:
+                break
+            nbytes += len(chunk)
+    timings['fetch'] = time.perf_counter() - fetch_start
+    timings['total'] = time.perf_counter() - start
+    return {'ok': True, 'bytes': nbytes, **timings}
+
+
+def percentiles(values):
+    if not values:
+        return None
+    values = sorted(values)
+
+    def pick(fraction):
+        return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+    return {
+        'p50': pick(0.50),
+        'p95': pick(0.95),
+        'p99': pick(0.99),
+        'max': values[-1],
+        'mean': sum(values) / len(values),
+    }
+
+
+def memory_stats():
+    """RSS, PSS and private (unshared) memory of this process, in bytes"""
+    stats = {}
+    with open('/proc/self/smaps_rollup') as rollup:
+        for line in rollup:
+            parts = line.split()
+            if parts[0] in ('Rss:', 'Pss:', 'Private_Clean:', 'Private_Dirty:'):
+                stats[parts[0][:-1]] = int(parts[1]) * 1024
+    return {
+        'rss_bytes': stats['Rss'],
+        'pss_bytes': stats['Pss'],
+        'private_bytes': stats['Private_Clean'] + stats['Private_Dirty'],
+    }
+
+
+def startup_probe(preload):
+    """Runs in a fresh interpreter and forks one worker, like gunicorn
+
+    With preload the app is imported and warmed up in the master before the
+    fork; without it the worker imports the app itself after the fork.
+    """
+    report = {}
+    if preload:
+        start = time.perf_counter()
+        import app as app_module
+        report['import_seconds'] = time.perf_counter() - start
+        start = time.perf_counter()
+        app_module.create_app()
+        report['warm_up_seconds'] = time.perf_counter() - start
+        report['master'] = memory_stats()
+
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_end)
+        worker = {}
+        start = time.perf_counter()
+        if not preload:
+            import app as app_module
+            worker['import_seconds'] = time.perf_counter() - start
+        # A worker is ready once it has a YoutubeDL handle with the YouTube extractor
+        with app_module.ydl_pool.handle() as ydl:
+            ydl.get_info_extractor('Youtube')
+        worker['ready_seconds'] = time.perf_counter() - start
+        worker.update(memory_stats())
+        os.write(write_end, json.dumps(worker).encode('utf-8'))
+        os._exit(0)
+    os.close(write_end)
+    with os.fdopen(read_end) as pipe:
+        report['worker'] = json.loads(pipe.read())
+    os.waitpid(pid, 0)
+    print(json.dumps(report))
+
+
+def isolated_paths(workdir):
+    """Environment that keeps a run's files and job journal apart from a real deployment"""
+    return {
+        'CACHE_DIR': os.path.join(workdir, 'cache'),
+        'JOBS_DIR': os.path.join(workdir, 'jobs'),
+        'PROGRESS_DB': os.path.join(workdir, 'progress.db'),
+        'JOURNAL_DB': os.path.join(workdir, 'journal.db'),
+    }
+
+
+def run_startup_benchmark():
+    """Probe every EXTRACTORS setting with and without preloading, each in a new process"""
+    results = []
+    for extractors in ('all', 'youtube'):
+        for preload in (False, True):
+            workdir = tempfile.mkdtemp(prefix='youtube-downloader-bench-')
+            env = dict(os.environ, EXTRACTORS=extractors, **isolated_paths(workdir))
+            start = time.perf_counter()
+            try:
+                output = subprocess.run(
+                    [sys.executable, os.path.abspath(__file__), '--startup-probe'] + (['--preload'] if preload else []),
+                    env=env, check=True, capture_output=True, text=True).stdout
+            finally:
+                shutil.rmtree(workdir, ignore_errors=True)
+            probe = json.loads(output.strip().splitlines()[-1])
+            probe.update({'extractors': extractors, 'preload': preload,
+                          'process_seconds': time.perf_counter() - start})
+            results.append(probe)
+    return {'startup': results}
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--cycles', type=int, default=20, help='download cycles to run')
+    parser.add_argument('--concurrency', type=int, default=4, help='cycles in flight at once')
+    parser.add_argument('--videos', type=int, default=0,
+                        help='distinct video IDs (default: one per cycle, so nothing hits the cache)')
+    parser.add_argument('--size', type=int, default=5 * 1024 * 1024, help='bytes per synthetic video')
+    parser.add_argument('--mode', choices=('progressive', 'dash'), default='progressive',
+                        help='single-file MP4 or DASH fragments')
+    parser.add_argument('--segments', type=int, default=10, help='fragments per DASH video')
+    parser.add_argument('--origin-rate', type=int, default=0,
+                        help='origin bytes/s per connection (0 for unlimited)')
+    parser.add_argument('--poll-interval', type=float, default=0.1, help='progress polling interval')
+    parser.add_argument('--timeout', type=float, default=300, help='seconds before a cycle is abandoned')
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    parser.add_argument('--startup', action='store_true',
+                        help='report cold start time and worker memory instead of running cycles')
+    parser.add_argument('--startup-probe', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--preload', action='store_true', help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def write_report(report, path):
+    output = json.dumps(report, indent=2)
+    if path:
+        with open(path, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.startup_probe:
+        startup_probe(args.preload)
+        return 0
+    if args.startup:
+        write_report(run_startup_benchmark(), args.output)
+        return 0
+
+    # Keep the run's files apart from a real deployment, and let every cycle queue
+    workdir = tempfile.mkdtemp(prefix='youtube-downloader-bench-')
+    os.environ.update(isolated_paths(workdir))
+    os.environ.setdefault('MAX_QUEUED_DOWNLOADS', str(max(args.cycles, 50)))
+    # Every cycle comes from 127.0.0.1
+    os.environ.setdefault('MAX_DOWNLOADS_PER_CLIENT', str(max(args.cycles, 50)))
+
+    import app as app_module
+    app_module.app.logger.setLevel(logging.WARNING)
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+
+    origin = start_origin(args.size, args.segments, args.origin_rate)
+    origin_url = f'http://127.0.0.1:{origin.server_port}'
+    install_stub_extractor(app_module, make_stub_extractor(origin_url, args.size, args.mode, args.segments))
+    server = start_app(app_module)
+    base = f'http://127.0.0.1:{server.server_port}'
+
+    videos = args.videos or args.cycles
+    sampler = ResourceSampler()
+    fds_before = ResourceSampler.open_fds()
+    sampler.start()
+    start = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(args.concurrency) as executor:
+            results = list(executor.map(
+                lambda index: run_cycle(base, f'{origin_url}/watch?v=bench-{index % videos}',
+                                        args.poll_interval, args.timeout),
+                range(args.cycles)))
+    finally:
+        wall = time.perf_counter() - start
+        sampler.stop()
+        server.shutdown()
+        origin.shutdown()
+
+    ok = [result for result in results if result['ok']]
+    total_bytes = sum(result['bytes'] for result in ok)
+    report = {
+        'config': vars(args),
+        'cycles': args.cycles,
+        'succeeded': len(ok),
+        'failed': len(results) - len(ok),
+        'errors': sorted({result['error'] for result in results if not result['ok']}),
+        'wall_seconds': wall,
+        'cycles_per_second': len(ok) / wall if wall else None,
+        'served_bytes_per_second': total_bytes / wall if wall else None,
+        'latency_seconds': {
+            phase: percentiles([result[phase] for result in ok])
+            for phase in ('submit', 'ready', 'ttfb', 'fetch', 'total')
+        },
+        'peak_rss_bytes': max(sampler.peak_rss, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024),
+        'open_fds': {
+            'before': fds_before,
+            'peak': sampler.peak_fds,
+            'after': ResourceSampler.open_fds(),
+        },
+    }
+    shutil.rmtree(workdir, ignore_errors=True)
+
+    write_report(report, args.output)
+    return 0 if not report['failed'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
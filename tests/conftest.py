@@ -0,0 +1,7 @@
+import os
+import sys
+import tempfile
+
+# app.py keeps its databases, cache and job directories under the temp dir at import
+tempfile.tempdir = tempfile.mkdtemp(prefix='youtube-downloader-tests-')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,51 @@
+import asyncio
+
+import flask
+import pytest
+
+import asgi
+
+
+@pytest.fixture
+def served(tmp_path, monkeypatch):
+    path = tmp_path / 'video.mp4'
+    path.write_bytes(bytes(range(256)) * 64)
+    site = flask.Flask(__name__)
+    site.add_url_rule('/file', 'file', lambda: flask.send_file(path, conditional=True))
+    monkeypatch.setattr(asgi, 'app', site)
+    return path.read_bytes()
+
+
+def get(headers=(), extensions=None):
+    scope = {'type': 'http', 'method': 'GET', 'path': '/file', 'raw_path': b'/file', 'query_string': b'',
+             'headers': [(b'host', b'test')] + list(headers), 'server': ('test', 80), 'client': ('127.0.0.1', 1),
+             'scheme': 'http', 'root_path': '', 'http_version': '1.1', 'extensions': extensions or {}}
+    requests = [{'type': 'http.request', 'body': b'', 'more_body': False}]
+    messages = []
+
+    async def receive():
+        if requests:
+            return requests.pop()
+        await asyncio.Event().wait()
+
+    async def send(message):
+        messages.append(message)
+
+    asyncio.run(asgi.call_wsgi(scope, receive, send))
+    return messages
+
+
+def test_file_response_is_sent_natively(served):
+    messages = get()
+    assert messages[0]['status'] == 200
+    assert b''.join(m.get('body', b'') for m in messages[1:]) == served
+    [zerocopy] = get(extensions={'http.response.zerocopysend': {}})[1:]
+    assert (zerocopy['offset'], zerocopy['count']) == (0, len(served))
+
+
+def test_range_response_sends_the_requested_span(served):
+    messages = get([(b'range', b'bytes=100-4195')])
+    assert messages[0]['status'] == 206
+    assert b''.join(m.get('body', b'') for m in messages[1:]) == served[100:4196]
+    [zerocopy] = get([(b'range', b'bytes=-10')], extensions={'http.response.zerocopysend': {}})[1:]
+    assert (zerocopy['offset'], zerocopy['count']) == (len(served) - 10, 10)
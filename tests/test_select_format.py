@@ -0,0 +1,104 @@
+import pytest
+
+import app
+
+
+def audio(format_id, ext, acodec, abr, **fields):
+    return {'format_id': format_id, 'ext': ext, 'vcodec': 'none', 'acodec': acodec, 'abr': abr, **fields}
+
+
+def video(format_id, height, ext='mp4', vcodec='avc1.640028', acodec='none', **fields):
+    return {'format_id': format_id, 'ext': ext, 'vcodec': vcodec, 'acodec': acodec, 'height': height, **fields}
+
+
+# Formats as yt-dlp lists them: worst first
+DUBBED = [
+    audio('140-0', 'm4a', 'mp4a.40.2', 129.5, language='de', language_preference=-1, quality=3),
+    audio('251-0', 'webm', 'opus', 135.1, language='de', language_preference=-1, quality=3),
+    audio('140-1', 'm4a', 'mp4a.40.2', 129.5, language='en', language_preference=10, quality=3),
+    audio('251-1', 'webm', 'opus', 135.1, language='en', language_preference=10, quality=3),
+    audio('140-2', 'm4a', 'mp4a.40.2', 129.5, language='fr', language_preference=-1, quality=3),
+    audio('251-2', 'webm', 'opus', 135.1, language='fr', language_preference=-1, quality=3),
+]
+
+DRC = [
+    audio('140', 'm4a', 'mp4a.40.2', 129.5, quality=3),
+    audio('140-drc', 'm4a', 'mp4a.40.2', 129.5, quality=2.5),
+    audio('251', 'webm', 'opus', 135.1, quality=3),
+    audio('251-drc', 'webm', 'opus', 135.1, quality=2.5),
+]
+
+
+def request(**data):
+    return app.parse_format_request(data)
+
+
+@pytest.fixture(autouse=True)
+def ffmpeg(monkeypatch):
+    monkeypatch.setattr(app, 'FFMPEG_AVAILABLE', True)
+
+
+def test_audio_prefers_original_language_over_dubs():
+    assert app.select_format({'formats': DUBBED}, request(mode='audio')) == '251-1'
+    assert app.select_format({'formats': list(reversed(DUBBED))}, request(mode='audio')) == '251-1'
+
+
+def test_audio_skips_drc_variant_at_same_bitrate():
+    assert app.select_format({'formats': DRC}, request(mode='audio')) == '251'
+    assert app.select_format({'formats': DRC}, request(mode='audio', remux='m4a')) == '140'
+
+
+def test_audio_lowest_keeps_original_language():
+    formats = DUBBED + [audio('139-1', 'm4a', 'mp4a.40.5', 48.8, language='en', language_preference=10, quality=1),
+                        audio('139-0', 'm4a', 'mp4a.40.5', 48.8, language='de', language_preference=-1, quality=1)]
+    assert app.select_format({'formats': formats}, request(mode='audio', quality='lowest')) == '139-1'
+
+
+def test_audio_remux_honours_lowest():
+    formats = [audio('139', 'm4a', 'mp4a.40.5', 48.8), audio('140', 'm4a', 'mp4a.40.2', 129.5),
+               audio('251', 'webm', 'opus', 135.1)]
+    assert app.select_format({'formats': formats}, request(mode='audio', remux='m4a')) == '140'
+    assert app.select_format({'formats': formats}, request(mode='audio', remux='m4a', quality='lowest')) == '139'
+    assert app.select_format({'formats': formats}, request(mode='audio', remux='opus')) == '251'
+
+
+def test_audio_ties_go_to_yt_dlp_preference():
+    formats = [audio('a', 'm4a', 'mp4a.40.2', 128), audio('b', 'm4a', 'mp4a.40.2', 128)]
+    assert app.select_format({'formats': formats}, request(mode='audio')) == 'b'
+
+
+def test_merge_uses_original_language_audio():
+    info = {'formats': DUBBED + [video('137', 1080)]}
+    assert app.select_format(info, request(merge=True)) == '137+140-1'
+    info = {'formats': DRC + [video('248', 1080, ext='webm', vcodec='vp9')]}
+    assert app.select_format(info, request(merge=True)) == '248+251'
+
+
+def test_video_height_and_lowest():
+    formats = [video('18', 360, acodec='mp4a.40.2'), video('22', 720, acodec='mp4a.40.2')]
+    assert app.select_format({'formats': formats}, request()) == '22'
+    assert app.select_format({'formats': formats}, request(quality='480p')) == '18'
+    assert app.select_format({'formats': formats}, request(quality='lowest')) == '18'
+    assert app.select_format({'formats': formats}, request(max_height=100)) == '18'
+
+
+def test_unknown_format_id():
+    with pytest.raises(ValueError):
+        app.select_format({'formats': DRC}, request(format_id='999'))
+
+
+def test_remux_rejects_codec_the_container_cannot_hold():
+    opus_only = {'formats': [audio('249', 'webm', 'opus', 50.0), audio('251', 'webm', 'opus', 135.1)]}
+    format_request = request(mode='audio', remux='m4a')
+    selected = {'format_id': app.select_format(opus_only, format_request), 'ext': 'webm', 'acodec': 'opus'}
+    with pytest.raises(ValueError, match='m4a cannot hold opus'):
+        app.remux_target(format_request, selected)
+
+
+def test_remux_target():
+    assert app.remux_target(request(mode='audio', remux='opus'),
+                            {'format_id': '251', 'ext': 'webm', 'acodec': 'opus'}) == 'opus'
+    assert app.remux_target(request(mode='audio', remux='m4a'),
+                            {'format_id': '140', 'ext': 'm4a', 'acodec': 'mp4a.40.2'}) is None
+    assert app.remux_target(request(remux='mkv'),
+                            {'format_id': '137+251', 'ext': 'mp4', 'acodec': 'opus'}) == 'mkv'
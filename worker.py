@@ -0,0 +1,93 @@
+"""Download worker: runs the jobs that the web front-end puts in the job journal
+
+    JOB_RUNNER=worker PROGRESS_STORE=sqlite gunicorn 'app:create_app()' --preload ...
+    JOB_RUNNER=worker PROGRESS_STORE=sqlite python worker.py
+
+With JOB_RUNNER=worker the front-end only validates, journals and reports on
+jobs, so downloads never compete with /api/info or the page for its threads.
+Each worker process claims queued jobs from the journal (JOURNAL_DB), runs up
+to MAX_CONCURRENT_DOWNLOADS of them at once, and publishes progress and the
+finished file's location in the shared progress store (PROGRESS_DB), where the
+front-end serves them from. Start as many workers as there are cores to use;
+all of them and the front-end need the same JOURNAL_DB, PROGRESS_DB and
+CACHE_DIR.
+
+On SIGTERM a worker stops claiming jobs and exits once its running jobs are
+done. Jobs of a worker that is killed are requeued by the others (or by the
+next worker to start) and continue from their partial files.
+"""
+import logging
+import os
+import signal
+import threading
+
+import app as downloader
+from app import journal
+
+# How long an idle worker thread waits before looking for queued jobs again
+WORKER_POLL_INTERVAL = float(os.environ.get('WORKER_POLL_INTERVAL', 1.0))
+
+logger = logging.getLogger('worker')
+
+
+def run_job(download_id, kind, parent, job):
+    """Run a claimed journal job; batch items take their settings from the batch"""
+    settings = journal.request(parent) if kind == 'batch_item' else job
+    if settings is None:
+        logger.warning('Batch %s of %s is gone from the journal', parent, download_id)
+        downloader.fail_orphaned_items([download_id])
+        return
+    downloader.download_video(job['url'], download_id, settings['format_request'],
+                              concurrent_fragments=settings['concurrent_fragments'],
+                              client=settings['client'])
+
+
+def work(stop):
+    while not stop.is_set():
+        try:
+            claimed = journal.claim_next()
+        except Exception:
+            # For example "database is locked" once the busy timeout runs out
+            logger.exception('Could not claim a job')
+            stop.wait(WORKER_POLL_INTERVAL)
+            continue
+        if claimed is None:
+            stop.wait(WORKER_POLL_INTERVAL)
+            continue
+        logger.info('Running %s %s', claimed[1], claimed[0])
+        try:
+            run_job(*claimed)
+        except Exception:
+            logger.exception('Job %s failed', claimed[0])
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(levelname)s %(message)s')
+    if downloader.JOB_RUNNER != 'worker':
+        raise SystemExit('worker.py runs the jobs of a JOB_RUNNER=worker front-end; set JOB_RUNNER=worker')
+
+    downloader.warm_up()
+    downloader.janitor.start()
+    requeued = journal.requeue_orphaned()
+    if requeued:
+        logger.info('Requeued %d jobs of workers that died', requeued)
+
+    stop = threading.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda *_: stop.set())
+
+    threads = [threading.Thread(target=work, args=(stop,), name=f'download-{n}')
+               for n in range(downloader.MAX_CONCURRENT_DOWNLOADS)]
+    for thread in threads:
+        thread.start()
+    logger.info('Worker %d running %d download threads', os.getpid(), len(threads))
+    # Wake up regularly so the signal handler runs
+    while not stop.wait(1):
+        pass
+    logger.info('Stopping: finishing running jobs')
+    for thread in threads:
+        thread.join()
+
+
+if __name__ == '__main__':
+    main()